@@ -0,0 +1,188 @@
+import argparse
+import importlib.util
+import os
+import tempfile
+import time
+
+import torch
+
+from layer import dilated_inception, fused_inception
+from model import MTGNN_Model
+from util import CompiledModel, DataLoader
+
+
+def timeit(fn, repeat, warmup=2):
+    for _ in range(warmup):
+        fn()
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start_time) / repeat
+
+
+def bench_tconv(args):
+    # separate filter/gate dilated_inception layers against one fused_inception, forward and forward + backward
+    filter_conv = dilated_inception(args.channels, args.channels, dilation_factor=args.dilation)
+    gate_conv = dilated_inception(args.channels, args.channels, dilation_factor=args.dilation)
+    fused = fused_inception.from_inception(filter_conv, gate_conv)
+    x = torch.randn(args.batch_size, args.channels, args.num_nodes, args.seq_len, requires_grad=True)
+
+    def unfused_forward():
+        return torch.tanh(filter_conv(x)) * torch.sigmoid(gate_conv(x))
+
+    with torch.no_grad():
+        error = (unfused_forward() - fused(x)).abs().max().item()
+        unfused_time = timeit(unfused_forward, args.repeat)
+        fused_time = timeit(lambda: fused(x), args.repeat)
+    unfused_train_time = timeit(lambda: unfused_forward().sum().backward(), args.repeat)
+    fused_train_time = timeit(lambda: fused(x).sum().backward(), args.repeat)
+    print(f"Max abs difference {error}")
+    print(f"Forward | unfused {unfused_time * 1000:.2f}ms | fused {fused_time * 1000:.2f}ms | "
+          f"speedup {unfused_time / fused_time:.2f}x")
+    print(f"Forward + backward | unfused {unfused_train_time * 1000:.2f}ms | fused {fused_train_time * 1000:.2f}ms | "
+          f"speedup {unfused_train_time / fused_train_time:.2f}x")
+
+
+def build_model(args, **kwargs):
+    return MTGNN_Model(True, True, args.gcn_depth, args.num_nodes, torch.device('cpu'), subgraph_size=args.subgraph_size,
+                       node_dim=40, dilation_exponential=args.dilation_exponential, conv_channels=args.channels,
+                       residual_channels=args.channels, skip_channels=2 * args.channels,
+                       end_channels=4 * args.channels, seq_length=args.seq_len, in_dim=1, out_dim=1,
+                       layers=args.layers, layer_norm_affline=False, **kwargs)
+
+
+def bench_layout(args):
+    # the same model run with the NCHW layout and with the node-major layout
+    nchw = build_model(args, layout='nchw')
+    node_major = build_model(args, layout='node_major')
+    node_major.load_state_dict(nchw.state_dict())
+    x = torch.randn(args.batch_size, 1, args.num_nodes, args.seq_len)
+    nchw.eval()
+    node_major.eval()
+    with torch.no_grad():
+        # same seed for the tie-breaking noise of the graph constructor
+        torch.manual_seed(0)
+        expected = nchw(x)
+        torch.manual_seed(0)
+        error = (expected - node_major(x)).abs().max().item()
+    for name, model in [('nchw', nchw), ('node_major', node_major)]:
+        model.eval()
+        with torch.no_grad():
+            forward_time = timeit(lambda: model(x), args.repeat)
+        model.train()
+        train_time = timeit(lambda: model(x).sum().backward(), args.repeat)
+        print(f"{name} | forward {forward_time * 1000:.2f}ms | forward + backward {train_time * 1000:.2f}ms")
+    print(f"Max abs difference {error}")
+
+
+def saved_activations(fn):
+    # bytes of the tensors autograd saves for the backward while fn runs its forward
+    total = [0]
+
+    def pack(tensor):
+        total[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn()
+    return out, total[0]
+
+
+def bench_checkpoint(args):
+    # activation memory and step time with and without per-block checkpointing
+    x = torch.randn(args.batch_size, 1, args.num_nodes, args.seq_len)
+    for checkpoint_blocks in [False, True]:
+        model = build_model(args, checkpoint_blocks=checkpoint_blocks)
+        model.train()
+        out, saved = saved_activations(lambda: model(x))
+        out.sum().backward()
+        train_time = timeit(lambda: model(x).sum().backward(), args.repeat)
+        print(f"checkpoint_blocks={checkpoint_blocks} | saved activations {saved / 2 ** 20:.1f}MB | "
+              f"forward + backward {train_time * 1000:.2f}ms")
+
+
+def bench_bf16(args):
+    # fp32 against bfloat16 autocast, on test windows of --data when given, random input otherwise
+    if args.data:
+        data = DataLoader(args.data, 0.6, 0.2, torch.device('cpu'), 3, args.seq_len, normalize=2)
+        args.num_nodes = data.m
+        x = data.test[0][:args.batch_size].transpose(1, 2).unsqueeze(1)
+    else:
+        x = torch.randn(args.batch_size, 1, args.num_nodes, args.seq_len)
+    model = build_model(args)
+    model.eval()
+    outputs = {}
+    for bf16 in [False, True]:
+        def forward():
+            with torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+                return model(x).float()
+
+        def forward_backward():
+            forward().sum().backward()
+
+        with torch.no_grad():
+            torch.manual_seed(0)
+            outputs[bf16] = forward()
+            forward_time = timeit(forward, args.repeat)
+        model.train()
+        train_time = timeit(forward_backward, args.repeat)
+        model.eval()
+        print(f"bf16={bf16} | forward {forward_time * 1000:.2f}ms | forward + backward {train_time * 1000:.2f}ms")
+    error = outputs[True] - outputs[False]
+    print(f"Max abs difference {error.abs().max().item()} | "
+          f"relative RMS difference {(error.norm() / outputs[False].norm()).item()}")
+
+
+def bench_export(args):
+    # eager model against the TorchScript, torch.export and (with onnxruntime installed) ONNX artifacts of
+    # MTGNN_Model.export, loaded class-free
+    model = build_model(args)
+    model.eval()
+    x = torch.randn(args.batch_size, 1, args.num_nodes, args.seq_len)
+    with torch.no_grad():
+        torch.manual_seed(0)
+        expected = model(x)
+        eager_time = timeit(lambda: model(x), args.repeat)
+    print(f"eager | forward {eager_time * 1000:.2f}ms")
+    formats = ['model.pt', 'model.pt2']
+    if importlib.util.find_spec('onnxruntime') is not None:
+        formats.append('model.onnx')
+    with tempfile.TemporaryDirectory() as tmp:
+        for path in [os.path.join(tmp, name) for name in formats]:
+            torch.manual_seed(0)
+            model.export(path, args.batch_size)
+            compiled = CompiledModel(path)
+            error = (expected - compiled(x)).abs().max().item()
+            compiled_time = timeit(lambda: compiled(x), args.repeat)
+            print(f"{os.path.basename(path)} | forward {compiled_time * 1000:.2f}ms | speedup "
+                  f"{eager_time / compiled_time:.2f}x | max abs difference {error}")
+            # the graph noise is seeded the same for the eager run and the export, so only numerics differ
+            if not error <= args.export_tolerance:
+                raise AssertionError(f'{os.path.basename(path)} differs from the eager model by {error}, more than '
+                                     f'{args.export_tolerance}')
+
+
+BENCHMARKS = {'tconv': bench_tconv, 'layout': bench_layout, 'checkpoint': bench_checkpoint, 'bf16': bench_bf16,
+              'export': bench_export}
+
+parser = argparse.ArgumentParser(description='MTGNN layer benchmarks')
+parser.add_argument('--bench', type=str, default='tconv', choices=sorted(BENCHMARKS))
+parser.add_argument('--data', type=str, default=None, help='data file for the benchmarks that use real windows')
+parser.add_argument('--batch_size', type=int, default=32, help='batch size')
+parser.add_argument('--num_nodes', type=int, default=137, help='number of nodes/variables')
+parser.add_argument('--channels', type=int, default=16, help='convolution channels')
+parser.add_argument('--seq_len', type=int, default=24 * 7, help='input sequence length')
+parser.add_argument('--dilation', type=int, default=1, help='dilation factor')
+parser.add_argument('--dilation_exponential', type=int, default=2, help='dilation exponential')
+parser.add_argument('--layers', type=int, default=5, help='number of layers')
+parser.add_argument('--gcn_depth', type=int, default=2, help='graph convolution depth')
+parser.add_argument('--subgraph_size', type=int, default=20, help='k')
+parser.add_argument('--repeat', type=int, default=10, help='timed repetitions')
+parser.add_argument('--export_tolerance', type=float, default=1e-4,
+                    help='max abs difference of an exported artifact from the eager model at most')
+parser.add_argument('--threads', type=int, default=3, help='torch threads')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    BENCHMARKS[args.bench](args)
@@ -3,9 +3,12 @@ from __future__ import division
 import numbers
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.ao.quantization import DeQuantStub, QuantStub
 from torch.nn import init
+from torch.utils.checkpoint import checkpoint
 
 
 class nconv(nn.Module):
@@ -13,9 +16,27 @@ class nconv(nn.Module):
         super(nconv, self).__init__()
 
     def forward(self, x, A):
-        x = torch.einsum('ncwl,vw->ncvl', (x, A))
+        if A.is_sparse:
+            # (N, C, W, L) -> (W, N*C*L) so the k-NN adjacency is applied with a single sparse matmul
+            n, c, w, l = x.shape
+            # sparse matmul has no bfloat16 autocast rule, it runs in the dtype of the adjacency
+            with full_precision(x):
+                x = torch.sparse.mm(A, x.to(A.dtype).permute(2, 0, 1, 3).reshape(w, -1))
+            x = x.view(A.size(0), n, c, l).permute(1, 2, 0, 3)
+        else:
+            x = torch.einsum('ncwl,vw->ncvl', (x, A))
         return x.contiguous()
 
+    def forward_node_major(self, x, A):
+        # x is (N, B, C, T), so propagation is a single (N, N) x (N, B*C*T) matmul on a view, without copies
+        h = x.reshape(x.size(0), -1)
+        if A.is_sparse:
+            with full_precision(h):
+                h = torch.sparse.mm(A, h.to(A.dtype))
+        else:
+            h = torch.mm(A, h)
+        return h.view(A.size(0), *x.shape[1:])
+
 
 class dy_nconv(nn.Module):
     def __init__(self):
@@ -26,6 +47,14 @@ class dy_nconv(nn.Module):
         return x.contiguous()
 
 
+def conv_node_major(conv, x):
+    # a Conv2d with a (1, k) kernel applied to a node-major (N, B, C, T) tensor, as a conv1d over its (N*B, C, T) view
+    n, b, c, t = x.shape
+    y = F.conv1d(x.reshape(n * b, c, t), conv.weight.squeeze(2), conv.bias, stride=conv.stride[1],
+                 padding=conv.padding[1], dilation=conv.dilation[1])
+    return y.view(n, b, y.size(1), y.size(2))
+
+
 class linear(nn.Module):
     def __init__(self, c_in, c_out, bias=True):
         super(linear, self).__init__()
@@ -35,6 +64,202 @@ class linear(nn.Module):
         return self.mlp(x)
 
 
+class quant_conv(nn.Module):
+    """
+    A Conv2d with float input and output around it, so torch.ao.quantization can swap in the int8 convolution
+    wherever it sits in the model while the graph propagation and LayerNorm in between stay fp32.
+    """
+
+    def __init__(self, conv):
+        super(quant_conv, self).__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def full_precision(x):
+    # region with autocast switched off, for the ops that have to stay fp32 inside a bfloat16 autocast region
+    return torch.autocast(x.device.type, enabled=False)
+
+
+def normalize_adj(adj):
+    # row-normalized A + I, as used by every propagation step, always in fp32
+    with full_precision(adj):
+        return _normalize_adj(adj.float())
+
+
+def _normalize_adj(adj):
+    if adj.is_sparse:
+        adj = adj.coalesce()
+        n = adj.size(0)
+        loop = torch.arange(n, device=adj.device)
+        rows = torch.cat([adj.indices()[0], loop])
+        cols = torch.cat([adj.indices()[1], loop])
+        values = torch.cat([adj.values(), torch.ones(n, device=adj.device, dtype=adj.dtype)])
+        d = torch.zeros(n, device=adj.device, dtype=adj.dtype).index_add(0, rows, values)
+        return torch.sparse_coo_tensor(torch.stack([rows, cols]), values / d[rows], adj.shape).coalesce()
+    adj = adj + torch.eye(adj.size(0), device=adj.device, dtype=adj.dtype)
+    d = adj.sum(1)
+    return adj / d.view(-1, 1)
+
+
+def use_sparse_prop(n, k, min_nodes=500, max_density=0.1):
+    # Sparse propagation costs O(N*k*C*L) against the dense O(N^2*C*L) but pays for the layout change around the
+    # sparse matmul, on CPU it only wins once the graph is a few hundred nodes large and the k-NN graph is thin.
+    return n >= min_nodes and k <= max_density * n
+
+
+class prop_plan(object):
+    """
+    Normalized adjacency for both propagation directions, built once per forward and shared by all the
+    prop/mixprop layers instead of each layer re-normalizing the same N x N matrix.
+    """
+
+    def __init__(self, adj):
+        self.adj = adj
+        self.out = normalize_adj(adj)
+        self.inn = normalize_adj(adj.transpose(1, 0))
+
+
+class _gather_rows(torch.autograd.Function):
+    """
+    Concatenation of the rows (dim 0) of every rank, padded to the largest rank for the all_gather. In the backward
+    every rank keeps the gradient of its own rows: summed over the ranks with reduce_grad, as is, without it, which
+    is for outputs every rank computes the same loss from.
+    """
+
+    @staticmethod
+    def forward(ctx, x, sizes, reduce_grad):
+        ctx.sizes = sizes
+        ctx.reduce_grad = reduce_grad
+        padded = x.new_zeros((max(sizes),) + tuple(x.shape[1:]))
+        padded[:x.size(0)] = x
+        parts = [torch.empty_like(padded) for _ in sizes]
+        dist.all_gather(parts, padded)
+        return torch.cat([part[:n] for part, n in zip(parts, sizes)])
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.contiguous()
+        if ctx.reduce_grad:
+            grad = grad.clone()
+            dist.all_reduce(grad)
+        start = sum(ctx.sizes[:dist.get_rank()])
+        return grad[start:start + ctx.sizes[dist.get_rank()]], None, None
+
+
+def gather_rows(x, sizes, reduce_grad=False):
+    return _gather_rows.apply(x, sizes, reduce_grad)
+
+
+class _all_reduce_sum(torch.autograd.Function):
+    # sum over the ranks, the gradient of every rank's contribution is the sum of the ranks' gradients of the total
+
+    @staticmethod
+    def forward(ctx, x):
+        x = x.clone()
+        dist.all_reduce(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.clone()
+        dist.all_reduce(grad)
+        return grad
+
+
+def _exchange(sends, shapes, like):
+    # point to point: sends[peer] goes to peer, a tensor of shapes[peer] is received from peer
+    received = {peer: like.new_empty(shape) for peer, shape in shapes.items()}
+    requests = [dist.irecv(tensor, peer) for peer, tensor in received.items()]
+    requests += [dist.isend(tensor, peer) for peer, tensor in sends.items()]
+    for request in requests:
+        request.wait()
+    return [received[peer] for peer in sorted(received)]
+
+
+class _halo_exchange(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, h, halo):
+        ctx.halo = halo
+        sends = {peer: h.index_select(2, rows) for peer, rows in halo.send.items()}
+        shapes = {peer: (h.size(0), h.size(1), n, h.size(3)) for peer, n in halo.recv.items()}
+        return torch.cat([h] + _exchange(sends, shapes, h), 2)
+
+    @staticmethod
+    def backward(ctx, grad):
+        # the halo gradients go back to the ranks owning those nodes and are added to their rows there
+        halo = ctx.halo
+        n = grad.size(2) - sum(halo.recv.values())
+        peers = sorted(halo.recv)
+        parts = grad[:, :, n:].split([halo.recv[peer] for peer in peers], 2)
+        sends = {peer: part.contiguous() for peer, part in zip(peers, parts)}
+        shapes = {peer: (grad.size(0), grad.size(1), rows.numel(), grad.size(3)) for peer, rows in halo.send.items()}
+        received = _exchange(sends, shapes, grad)
+        out = grad[:, :, :n].clone()
+        for peer, part in zip(sorted(halo.send), received):
+            out.index_add_(2, halo.send[peer], part)
+        return out, None
+
+
+class halo_plan(object):
+    """
+    One propagation direction of the graph on a rank of a node-partitioned run. adj holds the normalized rows of
+    the rank's own nodes over its own nodes followed by its halo, the nodes of other ranks those rows reach, in
+    ascending order. send[peer] are the rows of its own nodes in the halo of peer, recv[peer] the number of halo
+    rows peer owns. Edges are given as global (rows, cols, values), values with autograd.
+    """
+
+    def __init__(self, rows, cols, values, bounds, rank):
+        start, end = bounds[rank]
+
+        def halo_of(lo, hi):
+            return torch.unique(cols[(rows >= lo) & (rows < hi) & ((cols < lo) | (cols >= hi))])
+
+        halo = halo_of(start, end)
+        self.recv = {}
+        self.send = {}
+        for peer, (lo, hi) in enumerate(bounds):
+            if peer == rank:
+                continue
+            n = int(((halo >= lo) & (halo < hi)).sum())
+            if n:
+                self.recv[peer] = n
+            needed = halo_of(lo, hi)
+            needed = needed[(needed >= start) & (needed < end)] - start
+            if needed.numel():
+                self.send[peer] = needed
+        own = (rows >= start) & (rows < end)
+        c = cols[own]
+        inside = (c >= start) & (c < end)
+        local = torch.where(inside, c - start, end - start + torch.searchsorted(halo, c))
+        adj = torch.sparse_coo_tensor(torch.stack([rows[own] - start, local]), values[own],
+                                      (end - start, end - start + halo.numel()))
+        self.adj = normalize_adj(adj)
+
+    def exchange(self, h):
+        return _halo_exchange.apply(h, self)
+
+
+class node_partition(object):
+    """
+    Propagation plan of a rank in a node-partitioned run, for both directions, from the (N, k) neighbour lists and
+    edge weights of the whole graph.
+    """
+
+    def __init__(self, cols, values, bounds, rank):
+        n, k = cols.shape
+        rows = torch.arange(n, device=cols.device).repeat_interleave(k)
+        cols = cols.reshape(-1)
+        values = values.reshape(-1)
+        self.out = halo_plan(rows, cols, values, bounds, rank)
+        self.inn = halo_plan(cols, rows, values, bounds, rank)
+
+
 class prop(nn.Module):
     def __init__(self, c_in, c_out, gdep, dropout, alpha):
         super(prop, self).__init__()
@@ -44,12 +269,9 @@ class prop(nn.Module):
         self.dropout = dropout
         self.alpha = alpha
 
-    def forward(self, x, adj):
-        adj = adj + torch.eye(adj.size(0)).to(x.device)
-        d = adj.sum(1)
+    def forward(self, x, adj, normalized=False):
         h = x
-        dv = d
-        a = adj / dv.view(-1, 1)
+        a = adj if normalized else normalize_adj(adj)
         for i in range(self.gdep):
             h = self.alpha * x + (1 - self.alpha) * self.nconv(h, a)
         ho = self.mlp(h)
@@ -65,12 +287,10 @@ class mixprop(nn.Module):
         self.dropout = dropout
         self.alpha = alpha
 
-    def forward(self, x, adj):
-        adj = adj + torch.eye(adj.size(0)).to(x.device)
-        d = adj.sum(1)
+    def forward(self, x, adj, normalized=False):
         h = x
         out = [h]
-        a = adj / d.view(-1, 1)
+        a = adj if normalized else normalize_adj(adj)
         for i in range(self.gdep):
             h = self.alpha * x + (1 - self.alpha) * self.nconv(h, a)
             out.append(h)
@@ -78,9 +298,33 @@ class mixprop(nn.Module):
         ho = self.mlp(ho)
         return ho
 
+    def forward_node_major(self, x, adj, normalized=False):
+        h = x
+        out = [h]
+        a = adj if normalized else normalize_adj(adj)
+        for i in range(self.gdep):
+            h = self.alpha * x + (1 - self.alpha) * self.nconv.forward_node_major(h, a)
+            out.append(h)
+        ho = torch.cat(out, dim=2)
+        ho = conv_node_major(self.mlp.mlp, ho)
+        return ho
+
+    def forward_partitioned(self, x, halo):
+        # x holds the nodes of this rank, every hop first appends the halo rows its adjacency reaches, see halo_plan
+        h = x
+        out = [h]
+        for i in range(self.gdep):
+            h = self.alpha * x + (1 - self.alpha) * self.nconv(halo.exchange(h), halo.adj)
+            out.append(h)
+        ho = torch.cat(out, dim=1)
+        ho = self.mlp(ho)
+        return ho
+
 
 class dy_mixprop(nn.Module):
-    def __init__(self, c_in, c_out, gdep, dropout, alpha):
+    chunk_size = None
+
+    def __init__(self, c_in, c_out, gdep, dropout, alpha, chunk_size=None):
         super(dy_mixprop, self).__init__()
         self.nconv = dy_nconv()
         self.mlp1 = linear((gdep + 1) * c_in, c_out)
@@ -91,12 +335,16 @@ class dy_mixprop(nn.Module):
         self.alpha = alpha
         self.lin1 = linear(c_in, c_in)
         self.lin2 = linear(c_in, c_in)
+        # when set, the dynamic adjacency is never stored, see _chunked
+        self.chunk_size = chunk_size
 
     def forward(self, x):
         # adj = adj + torch.eye(adj.size(0)).to(x.device)
         # d = adj.sum(1)
         x1 = torch.tanh(self.lin1(x))
         x2 = torch.tanh(self.lin2(x))
+        if self.chunk_size:
+            return self._chunked(x, x1, x2, self.mlp1) + self._chunked(x, x2, x1, self.mlp2)
         adj = self.nconv(x1.transpose(2, 1), x2)
         adj0 = torch.softmax(adj, dim=2)
         adj1 = torch.softmax(adj.transpose(2, 1), dim=2)
@@ -119,6 +367,41 @@ class dy_mixprop(nn.Module):
 
         return ho1 + ho2
 
+    def _chunked(self, x, q, k, mlp):
+        # Propagation with the softmax adjacency p[v, w] = softmax_w(q_v . k_w) in blocks of chunk_size target nodes.
+        # The row normalizers are accumulated block by block with an online logsumexp, and every block is
+        # checkpointed, so neither the forward nor the backward holds more than (N, chunk_size) scores per sample
+        # and time step. The scores are recomputed for every hop instead of being stored.
+        lse = None
+        for w in range(0, q.size(2), self.chunk_size):
+            block = self._checkpoint(self._block_lse, q, k[:, :, w:w + self.chunk_size])
+            lse = block if lse is None else torch.logaddexp(lse, block)
+
+        h = x
+        out = [h]
+        for i in range(self.gdep):
+            hop = torch.cat([self._checkpoint(self._block_prop, q, k[:, :, w:w + self.chunk_size], h, lse)
+                             for w in range(0, q.size(2), self.chunk_size)], dim=2)
+            h = self.alpha * x + (1 - self.alpha) * hop
+            out.append(h)
+        ho = torch.cat(out, dim=1)
+        return mlp(ho)
+
+    @staticmethod
+    def _checkpoint(fn, *args):
+        if torch.is_grad_enabled():
+            return checkpoint(fn, *args, use_reentrant=False)
+        return fn(*args)
+
+    @staticmethod
+    def _block_lse(q, k):
+        return torch.logsumexp(torch.einsum('ncvl,ncwl->nvwl', q, k), dim=2)
+
+    @staticmethod
+    def _block_prop(q, k, h, lse):
+        p = torch.exp(torch.einsum('ncvl,ncwl->nvwl', q, k) - lse.unsqueeze(2))
+        return torch.einsum('ncvl,nvwl->ncwl', h, p)
+
 
 class dilated_1D(nn.Module):
     def __init__(self, cin, cout, dilation_factor=2):
@@ -150,9 +433,140 @@ class dilated_inception(nn.Module):
         x = torch.cat(x, dim=1)
         return x
 
+    def forward_node_major(self, input):
+        x = [conv_node_major(conv, input) for conv in self.tconv]
+        x = torch.cat([x_i[..., -x[-1].size(3):] for x_i in x], dim=2)
+        return x
+
+
+class ivf_index(object):
+    """
+    Inverted-file index for the top-k search of graph_constructor. The score v1_i.v2_j - v2_i.v1_j is the inner
+    product of the query [v1_i, v2_i] with the key [v2_j, -v1_j], so the keys are clustered with k-means and each
+    query is only scored against the members of the `nprobe` clusters whose centroids it scores highest. That is
+    O(N * nprobe * N / nclusters) instead of O(N^2). The embeddings move while training, so the keys are reassigned
+    to the centroids on every search and the centroids themselves are re-fitted every `refresh` searches. The index
+    is not module state, so the centroids follow the keys to their device on every search instead of on .to().
+    """
+
+    def __init__(self, nclusters, nprobe=2, refresh=100, iters=10):
+        self.nclusters = nclusters
+        self.nprobe = nprobe
+        self.refresh = refresh
+        self.iters = iters
+        self.centroids = None
+        self.searches = 0
+
+    def _assign(self, keys):
+        # nearest centroid in euclidean distance
+        return (torch.mm(keys, self.centroids.transpose(1, 0)) - 0.5 * (self.centroids ** 2).sum(1)).argmax(1)
+
+    def fit(self, keys):
+        nclusters = min(self.nclusters, keys.size(0))
+        if self.centroids is not None:
+            self.centroids = self.centroids.to(keys)
+        if self.centroids is None or self.centroids.size(0) != nclusters:
+            self.centroids = keys[torch.randperm(keys.size(0), device=keys.device)[:nclusters]].clone()
+        for _ in range(self.iters):
+            assign = self._assign(keys)
+            total = torch.zeros_like(self.centroids).index_add_(0, assign, keys)
+            count = torch.zeros(nclusters, device=keys.device, dtype=keys.dtype).index_add_(
+                0, assign, torch.ones_like(assign, dtype=keys.dtype))
+            # empty clusters keep their old centroid
+            filled = count > 0
+            self.centroids[filled] = total[filled] / count[filled].unsqueeze(1)
+
+    def search(self, queries, keys, k, refit=True):
+        if self.centroids is None or (refit and self.searches % self.refresh == 0):
+            self.fit(keys)
+        # the model may have been moved since the last fit
+        self.centroids = self.centroids.to(keys)
+        if refit:
+            self.searches += 1
+        n = queries.size(0)
+        assign = self._assign(keys)
+        probe = torch.mm(queries, self.centroids.transpose(1, 0)).topk(min(self.nprobe, self.centroids.size(0)), 1)[1]
+        best_s = torch.full((n, k), float('-inf'), device=queries.device, dtype=queries.dtype)
+        best_t = torch.zeros((n, k), device=queries.device, dtype=torch.long)
+        for c in range(self.centroids.size(0)):
+            members = (assign == c).nonzero().squeeze(1)
+            rows = (probe == c).any(1).nonzero().squeeze(1)
+            if members.numel() == 0 or rows.numel() == 0:
+                continue
+            s = torch.cat([best_s[rows], torch.mm(queries[rows], keys[members].transpose(1, 0))], 1)
+            t = torch.cat([best_t[rows], members.expand(rows.size(0), -1)], 1)
+            s, pos = s.topk(k, 1)
+            best_s[rows] = s
+            best_t[rows] = t.gather(1, pos)
+        # rows whose probed clusters held fewer than k keys fall back to an exact search
+        short = torch.isinf(best_s).any(1).nonzero().squeeze(1)
+        if short.numel() > 0:
+            best_t[short] = torch.mm(queries[short], keys.transpose(1, 0)).topk(k, 1)[1]
+        return best_t
+
+
+class fused_inception(nn.Module):
+    """
+    The filter and gate dilated_inception layers of a block as a single convolution. Slicing every branch to the
+    shortest output is the same as right-aligning its kernel in a zero-padded kernel of the largest size, so all
+    branches become one (1, 7) kernel, and the filter and gate branches are stacked on the output channels. A fixed
+    mask keeps the padded taps at zero, so training matches the separate layers exactly.
+    """
+
+    def __init__(self, cin, cout, dilation_factor=2):
+        super(fused_inception, self).__init__()
+        self.kernel_set = [2, 3, 6, 7]
+        branch = int(cout / len(self.kernel_set))
+        self.tconv = nn.Conv2d(cin, 2 * branch * len(self.kernel_set), (1, max(self.kernel_set)),
+                               dilation=(1, dilation_factor))
+        mask = torch.zeros_like(self.tconv.weight)
+        for i, kern in enumerate(self.kernel_set * 2):
+            mask[i * branch:(i + 1) * branch, :, :, -kern:] = 1
+        self.register_buffer('mask', mask)
+
+    @classmethod
+    def from_inception(cls, filter_conv, gate_conv):
+        # builds the fused layer from the trained filter and gate dilated_inception of a block
+        first = filter_conv.tconv[0]
+        fused = cls(first.in_channels, first.out_channels * len(filter_conv.kernel_set), first.dilation[1])
+        fused.to(first.weight.device)
+        weight = torch.zeros_like(fused.tconv.weight)
+        bias = []
+        i = 0
+        with torch.no_grad():
+            for conv in list(filter_conv.tconv) + list(gate_conv.tconv):
+                kern = conv.kernel_size[1]
+                weight[i:i + conv.out_channels, :, :, -kern:] = conv.weight
+                bias.append(conv.bias)
+                i += conv.out_channels
+            fused.tconv.weight.copy_(weight)
+            fused.tconv.bias.copy_(torch.cat(bias))
+        return fused
+
+    def forward(self, input):
+        if isinstance(self.tconv, quant_conv):
+            # int8, the mask is folded into the quantized weight, see MTGNN_Model.quantize
+            x = self.tconv(input)
+        else:
+            x = F.conv2d(input, self.tconv.weight * self.mask, self.tconv.bias, dilation=self.tconv.dilation)
+        filter, gate = x.chunk(2, dim=1)
+        return torch.tanh(filter) * torch.sigmoid(gate)
+
+    def forward_node_major(self, input):
+        n, b, c, t = input.shape
+        x = F.conv1d(input.reshape(n * b, c, t), (self.tconv.weight * self.mask).squeeze(2), self.tconv.bias,
+                     dilation=self.tconv.dilation[1])
+        filter, gate = x.view(n, b, x.size(1), x.size(2)).chunk(2, dim=2)
+        return torch.tanh(filter) * torch.sigmoid(gate)
+
 
 class graph_constructor(nn.Module):
-    def __init__(self, nnodes, k, dim, device, alpha=3, static_feat=None):
+    # defaults for models pickled before the block-wise and ANN modes existed
+    block_size = None
+    ann = None
+
+    def __init__(self, nnodes, k, dim, device, alpha=3, static_feat=None, block_size=None, ann_clusters=None,
+                 ann_probe=2, ann_refresh=100):
         super(graph_constructor, self).__init__()
         self.nnodes = nnodes
         if static_feat is not None:
@@ -170,8 +584,12 @@ class graph_constructor(nn.Module):
         self.dim = dim
         self.alpha = alpha
         self.static_feat = static_feat
+        # when set, the top-k is found block by block and the N x N score matrix is never built
+        self.block_size = block_size
+        # when set, the neighbours are searched approximately in an inverted-file index with this many clusters
+        self.ann = ivf_index(ann_clusters, ann_probe, ann_refresh) if ann_clusters else None
 
-    def forward(self, idx):
+    def _nodevec(self, idx):
         if self.static_feat is None:
             nodevec1 = self.emb1(idx)
             nodevec2 = self.emb2(idx)
@@ -181,16 +599,101 @@ class graph_constructor(nn.Module):
 
         nodevec1 = torch.tanh(self.alpha * self.lin1(nodevec1))
         nodevec2 = torch.tanh(self.alpha * self.lin2(nodevec2))
+        return nodevec1, nodevec2
+
+    def forward(self, idx, sparse=False):
+        # sparse=True returns the k-NN adjacency as a coalesced COO tensor instead of a masked dense matrix
+        nodevec1, nodevec2 = self._nodevec(idx)
+
+        if self.ann is not None:
+            return self._ann(nodevec1, nodevec2, sparse)
+        if self.block_size:
+            return self._blockwise(nodevec1, nodevec2, sparse)
 
         a = torch.mm(nodevec1, nodevec2.transpose(1, 0)) - torch.mm(nodevec2, nodevec1.transpose(1, 0))
         adj = F.relu(torch.tanh(self.alpha * a))
-        mask = torch.zeros(idx.size(0), idx.size(0)).to(self.device)
-        mask.fill_(float('0'))
         s1, t1 = (adj + torch.rand_like(adj) * 0.01).topk(self.k, 1)
-        mask.scatter_(1, t1, s1.fill_(1))
+        if sparse:
+            rows = torch.arange(idx.size(0), device=adj.device).repeat_interleave(self.k)
+            return torch.sparse_coo_tensor(torch.stack([rows, t1.reshape(-1)]), adj.gather(1, t1).reshape(-1),
+                                           adj.shape).coalesce()
+        # out of place, so that the graph also builds under torch.func.vmap (MTGNN_Ensemble)
+        mask = torch.zeros_like(adj).scatter(1, t1, torch.ones_like(s1))
         adj = adj * mask
         return adj
 
+    def _blockwise(self, nodevec1, nodevec2, sparse):
+        # The neighbours are selected without autograd, scoring block_size rows against block_size columns at a time
+        # and merging into a running top-k per row. Only the N*k kept scores are then recomputed with autograd, so
+        # memory is O(block_size^2 + N*k) and the gradients are those of the dense masked adjacency.
+        n = nodevec1.size(0)
+        b = self.block_size
+        with torch.no_grad():
+            top = [self._search_rows(nodevec1, nodevec2, r, min(r + b, n)) for r in range(0, n, b)]
+        return self._knn(nodevec1, nodevec2, torch.cat(top), sparse)
+
+    def _search_rows(self, nodevec1, nodevec2, start, end):
+        # running top-k of the rows start:end, scored against block_size columns at a time (all of them without)
+        n = nodevec1.size(0)
+        b = self.block_size or n
+        best_s, best_t = None, None
+        for c in range(0, n, b):
+            a = torch.mm(nodevec1[start:end], nodevec2[c:c + b].transpose(1, 0)) - \
+                torch.mm(nodevec2[start:end], nodevec1[c:c + b].transpose(1, 0))
+            s = F.relu(torch.tanh(self.alpha * a))
+            s = s + torch.rand_like(s) * 0.01
+            t = torch.arange(c, c + s.size(1), device=s.device).expand_as(s)
+            if best_s is not None:
+                s = torch.cat([best_s, s], 1)
+                t = torch.cat([best_t, t], 1)
+            best_s, pos = s.topk(min(self.k, s.size(1)), 1)
+            best_t = t.gather(1, pos)
+        return best_t
+
+    def neighbours(self, idx, start, end):
+        """
+        Top-k neighbours of the nodes at positions start:end of idx only, as an (end - start, k) tensor of positions
+        in idx and the matching edge weights with autograd. The node-partitioned mode assembles the graph from the
+        rows every rank computes for its own nodes, so no rank scores all N x N pairs.
+        """
+        nodevec1, nodevec2 = self._nodevec(idx)
+        with torch.no_grad():
+            if self.ann is not None:
+                cols = self.ann.search(torch.cat([nodevec1, nodevec2], 1)[start:end],
+                                       torch.cat([nodevec2, -nodevec1], 1), self.k)
+            else:
+                cols = self._search_rows(nodevec1, nodevec2, start, end)
+        rows = torch.arange(start, end, device=cols.device).unsqueeze(1)
+        a = (nodevec1[rows] * nodevec2[cols]).sum(2) - (nodevec2[rows] * nodevec1[cols]).sum(2)
+        return cols, F.relu(torch.tanh(self.alpha * a))
+
+    def _ann(self, nodevec1, nodevec2, sparse):
+        with torch.no_grad():
+            cols = self.ann.search(torch.cat([nodevec1, nodevec2], 1), torch.cat([nodevec2, -nodevec1], 1), self.k)
+        return self._knn(nodevec1, nodevec2, cols, sparse)
+
+    def _knn(self, nodevec1, nodevec2, cols, sparse):
+        # adjacency restricted to the (N, k) selected neighbours in cols, scores recomputed with autograd
+        n = nodevec1.size(0)
+        rows = torch.arange(n, device=nodevec1.device).repeat_interleave(self.k)
+        cols = cols.reshape(-1)
+        a = (nodevec1[rows] * nodevec2[cols]).sum(1) - (nodevec2[rows] * nodevec1[cols]).sum(1)
+        values = F.relu(torch.tanh(self.alpha * a))
+        if sparse:
+            return torch.sparse_coo_tensor(torch.stack([rows, cols]), values, (n, n)).coalesce()
+        return torch.zeros(n, n, device=values.device, dtype=values.dtype).index_put((rows, cols), values)
+
+    def ann_recall(self, idx):
+        # fraction of the exact top-k neighbours (without the tie-breaking noise) that the ANN index returns
+        with torch.no_grad():
+            nodevec1, nodevec2 = self._nodevec(idx)
+            a = torch.mm(nodevec1, nodevec2.transpose(1, 0)) - torch.mm(nodevec2, nodevec1.transpose(1, 0))
+            exact = a.topk(self.k, 1)[1]
+            approx = self.ann.search(torch.cat([nodevec1, nodevec2], 1), torch.cat([nodevec2, -nodevec1], 1), self.k,
+                                     refit=False)
+            hits = (exact.unsqueeze(2) == approx.unsqueeze(1)).any(2)
+        return hits.float().mean().item()
+
     def fullA(self, idx):
         if self.static_feat is None:
             nodevec1 = self.emb1(idx)
@@ -320,10 +823,40 @@ class LayerNorm(nn.Module):
             init.zeros_(self.bias)
 
     def forward(self, input, idx):
+        with full_precision(input):
+            input = input.float()
+            if self.elementwise_affine:
+                return F.layer_norm(input, tuple(input.shape[1:]), self.weight[:, idx, :], self.bias[:, idx, :], self.eps)
+            else:
+                return F.layer_norm(input, tuple(input.shape[1:]), self.weight, self.bias, self.eps)
+
+    def forward_node_major(self, input, idx):
+        with full_precision(input):
+            return self._node_major(input.float(), idx)
+
+    def forward_partitioned(self, input, idx):
+        # per sample statistics over (C, N, T) of the whole graph, from the sums of every rank over its own nodes
+        with full_precision(input):
+            input = input.float()
+            dims = (1, 2, 3)
+            stats = torch.stack([input.sum(dims), (input ** 2).sum(dims),
+                                 torch.full_like(input[:, 0, 0, 0], input[0].numel())], 1)
+            stats = _all_reduce_sum.apply(stats)
+            mean = (stats[:, 0] / stats[:, 2]).view(-1, 1, 1, 1)
+            var = (stats[:, 1] / stats[:, 2]).view(-1, 1, 1, 1) - mean ** 2
+            x = (input - mean) * torch.rsqrt(var + self.eps)
+            if self.elementwise_affine:
+                x = x * self.weight[:, idx, :] + self.bias[:, idx, :]
+            return x
+
+    def _node_major(self, input, idx):
+        # per sample statistics over (C, N, T) of a node-major (N, B, C, T) tensor
+        mean = input.mean(dim=(0, 2, 3), keepdim=True)
+        var = input.var(dim=(0, 2, 3), unbiased=False, keepdim=True)
+        x = (input - mean) * torch.rsqrt(var + self.eps)
         if self.elementwise_affine:
-            return F.layer_norm(input, tuple(input.shape[1:]), self.weight[:, idx, :], self.bias[:, idx, :], self.eps)
-        else:
-            return F.layer_norm(input, tuple(input.shape[1:]), self.weight, self.bias, self.eps)
+            x = x * self.weight[:, idx, :].transpose(1, 0).unsqueeze(1) + self.bias[:, idx, :].transpose(1, 0).unsqueeze(1)
+        return x
 
     def extra_repr(self):
         return '{normalized_shape}, eps={eps}, ' \
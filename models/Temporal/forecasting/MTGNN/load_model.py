@@ -1,6 +1,6 @@
 import argparse
+import itertools
 import json
-import math
 import os
 import time
 from pathlib import Path
@@ -8,52 +8,28 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 import torch.nn as nn
 
-from model import MTGNN_Model
+from model import MTGNN_Frozen, MTGNN_Model
 from trainer import Optim
 from util import *
 
 
 def evaluate(data, X, Y, model, eval_mse_loss, eval_l1_loss, batch_size):
     model.eval()
-    total_loss = 0
-    total_loss_l1 = 0
-    n_samples = 0
-    predicted_label = None
-    test = None
+    metrics = StreamingMetrics(len(X), data.m, data.device)
 
-    for X, Y in data.get_batches(X, Y, batch_size, False):
+    for X, Y in data.get_batches(X, Y, batch_size, False, prefetch=args.prefetch):
         X = torch.unsqueeze(X, dim=1)
         X = X.transpose(2, 3)
-        with torch.no_grad():
+        with torch.no_grad(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.bf16):
             output = model(X)
-        output = torch.squeeze(output)
+        output = torch.squeeze(output.float())
         if len(output.shape) == 1:
             output = output.unsqueeze(dim=0)
-        if predicted_label is None:
-            predicted_label = output
-            test = Y
-        else:
-            predicted_label = torch.cat((predicted_label, output))
-            test = torch.cat((test, Y))
 
         scale = data.scale.expand(output.size(0), data.m)
-        total_loss += eval_mse_loss(output * scale, Y * scale).item()
-        total_loss_l1 += eval_l1_loss(output * scale, Y * scale).item()
-        n_samples += (output.size(0) * data.m)
-
-    rse = math.sqrt(total_loss / n_samples) / data.rse
-    rae = (total_loss_l1 / n_samples) / data.rae
+        metrics.update(output, Y, eval_mse_loss(output * scale, Y * scale), eval_l1_loss(output * scale, Y * scale))
 
-    predicted_label = predicted_label.data.cpu().numpy()
-    actual_label = test.data.cpu().numpy()
-    sigma_p = (predicted_label).std(axis=0)
-    sigma_g = (actual_label).std(axis=0)
-    mean_p = predicted_label.mean(axis=0)
-    mean_g = actual_label.mean(axis=0)
-    index = (sigma_g != 0)
-    correlation = ((predicted_label - mean_p) * (actual_label - mean_g)).mean(axis=0) / (sigma_p * sigma_g)
-    correlation = (correlation[index]).mean()
-    return rse, rae, correlation, predicted_label, actual_label
+    return metrics.result(data.rse, data.rae)
 
 
 def train(data, X, Y, model, loss_function, optimizer, batch_size):
@@ -61,7 +37,7 @@ def train(data, X, Y, model, loss_function, optimizer, batch_size):
     total_loss = []
     n_samples = 0
     batch = 0
-    for X, Y in data.get_batches(X, Y, batch_size, True):
+    for X, Y in data.get_batches(X, Y, batch_size, True, prefetch=args.prefetch):
         model.zero_grad()
         X = torch.unsqueeze(X, dim=1)
         X = X.transpose(2, 3)
@@ -77,8 +53,9 @@ def train(data, X, Y, model, loss_function, optimizer, batch_size):
             id = torch.tensor(id).to(device)
             tx = X[:, :, id, :]
             ty = Y[:, id]
-            output = model(tx, id)
-            output = torch.squeeze(output)
+            with torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.bf16):
+                output = model(tx, id)
+            output = torch.squeeze(output.float())
             scale = data.scale.expand(output.size(0), data.m)
             scale = scale[:, id]
             loss = loss_function(output * scale, ty * scale)
@@ -91,6 +68,7 @@ def train(data, X, Y, model, loss_function, optimizer, batch_size):
             loss = loss.item() / (output.size(0) * data.m)
             print(f"Batch:{batch} | loss: {loss}")
         batch += 1
+    print(f"Time spent waiting on data: {data.stall_time}s")
     average_loss = sum(total_loss) / n_samples
     return average_loss, total_loss
 
@@ -107,9 +85,42 @@ parser.add_argument('--output_path', type=str, default='results',
 parser.add_argument('--optim', type=str, default='adam')
 parser.add_argument('--L1Loss', type=bool, default=True)
 parser.add_argument('--normalize', type=int, default=2)
+parser.add_argument('--streaming', action='store_true',
+                    help='fit the scalers chunk by chunk and normalize into a memory-mapped store, as without it')
+parser.add_argument('--chunk_rows', type=int, default=100000, help='rows per chunk in streaming mode')
 parser.add_argument('--device', type=str, default='cuda:1', help='')
 parser.add_argument('--gcn_true', type=bool, default=True, help='whether to add graph convolution layer')
 parser.add_argument('--buildA_true', type=bool, default=True, help='whether to construct adaptive adjacency matrix')
+parser.add_argument('--propagation', type=str, default='auto', choices=['auto', 'dense', 'sparse'],
+                    help='graph propagation with the dense or the sparse k-NN adjacency, auto picks by size and is '
+                         'sparse with the block-wise or ANN graph search')
+parser.add_argument('--gc_block_size', type=int, default=0,
+                    help='build the k-NN graph in blocks of this many nodes instead of the full N x N scores, 0 is off')
+parser.add_argument('--gc_ann_clusters', type=int, default=0,
+                    help='search the k-NN graph in an inverted-file index with this many clusters, 0 is exact')
+parser.add_argument('--gc_ann_probe', type=int, default=2, help='clusters scored per node in the ANN index')
+parser.add_argument('--gc_ann_refresh', type=int, default=100, help='forward passes between re-fits of the ANN index')
+parser.add_argument('--fused_tconv', action='store_true',
+                    help='convert the loaded model to fused filter/gate dilated inception convolutions')
+parser.add_argument('--layout', type=str, default='nchw', choices=['nchw', 'node_major'],
+                    help='activation layout, node_major makes graph propagation a single matmul')
+parser.add_argument('--bf16', action='store_true',
+                    help='bfloat16 autocast for the model forward, LayerNorm and the graph normalization stay fp32')
+parser.add_argument('--quantize', type=str, default=None, choices=['dynamic', 'static'],
+                    help='int8 post-training quantization of the loaded model, compared against the fp32 model')
+parser.add_argument('--calib_batches', type=int, default=10,
+                    help='validation batches the activation ranges are calibrated on for static quantization')
+parser.add_argument('--quant_tolerance', type=float, default=0.1,
+                    help='relative increase of the test RSE over the fp32 model the int8 model may have at most')
+parser.add_argument('--export', type=str, default=None,
+                    help='write the loaded model as an artifact specialized to batch_size, TorchScript or .pt2 torch.export')
+parser.add_argument('--compiled', type=str, default=None,
+                    help='evaluate an artifact written by --export instead of the saved model')
+parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnxruntime'],
+                    help='evaluate with PyTorch, or export the model to ONNX with the learned graph frozen and run onnxruntime')
+parser.add_argument('--ort_threads', type=int, default=0, help='onnxruntime intra-op threads, 0 is the runtime default')
+parser.add_argument('--ort_tolerance', type=float, default=1e-4,
+                    help='max abs difference of onnxruntime from the frozen PyTorch model at most')
 parser.add_argument('--gcn_depth', type=int, default=2, help='graph convolution depth')
 parser.add_argument('--num_nodes', type=int, default=137, help='number of nodes/variables')
 parser.add_argument('--dropout', type=float, default=0.3, help='dropout rate')
@@ -127,6 +138,7 @@ parser.add_argument('--horizon', type=int, default=3)
 parser.add_argument('--layers', type=int, default=5, help='number of layers')
 
 parser.add_argument('--batch_size', type=int, default=32, help='batch size')
+parser.add_argument('--prefetch', type=int, default=0, help='number of batches gathered ahead on a background thread')
 parser.add_argument('--lr', type=float, default=0.0001, help='learning rate')
 parser.add_argument('--weight_decay', type=float, default=0.00001, help='weight decay rate')
 
@@ -148,7 +160,8 @@ torch.set_num_threads(3)
 
 def main():
     Path(args.output_path).mkdir(exist_ok=True)
-    data = DataLoader(args.data, 0.6, 0.2, device, args.horizon, args.seq_in_len, args.sample_data, args.normalize)
+    data = DataLoader(args.data, 0.6, 0.2, device, args.horizon, args.seq_in_len, args.sample_data, args.normalize,
+                      streaming=args.streaming, chunk_rows=args.chunk_rows)
 
     model = MTGNN_Model(args.gcn_true, args.buildA_true, args.gcn_depth, args.num_nodes,
                         device, dropout=args.dropout, subgraph_size=args.subgraph_size,
@@ -157,7 +170,9 @@ def main():
                         skip_channels=args.skip_channels, end_channels=args.end_channels,
                         seq_length=args.seq_in_len, in_dim=args.in_dim, out_dim=args.seq_out_len,
                         layers=args.layers, propalpha=args.propalpha, tanhalpha=args.tanhalpha,
-                        layer_norm_affline=False)
+                        layer_norm_affline=False, propagation=args.propagation,
+                        gc_block_size=args.gc_block_size, gc_ann_clusters=args.gc_ann_clusters,
+                        gc_ann_probe=args.gc_ann_probe, gc_ann_refresh=args.gc_ann_refresh, layout=args.layout)
     model = model.to(device)
 
     print('The receptive field size is', model.receptive_field)
@@ -176,21 +191,64 @@ def main():
     all_batches_loss = []
 
     # Load the best saved model.
-    with open(args.output_path+"/"+args.save, 'rb') as f:
-        model = torch.load(f)
+    if args.compiled:
+        model = CompiledModel(args.compiled, device, args.ort_threads)
+    else:
+        with open(args.output_path+"/"+args.save, 'rb') as f:
+            model = torch.load(f, weights_only=False)
+        if args.fused_tconv:
+            model.fuse_temporal_convs()
+        model.layout = args.layout
+    evaluated = model
+    if args.quantize:
+        # the learned graph is built once and both the fp32 and the int8 run propagate over it, so that the
+        # comparison only measures the quantization error and not a different draw of the tie-break noise
+        torch.manual_seed(0)
+        evaluated = MTGNN_Frozen(model)
+        fp32_start_time = time.time()
+        fp32_acc, fp32_rae, fp32_corr, _, _ = evaluate(data, data.test[0], data.test[1], evaluated, eval_mse_loss,
+                                                       eval_l1_loss, args.batch_size)
+        fp32_time = time.time() - fp32_start_time
+        calibration = (X.unsqueeze(1).transpose(2, 3) for X, _ in
+                       itertools.islice(data.get_batches(data.valid[0], data.valid[1], args.batch_size, False),
+                                        args.calib_batches))
+        model.quantize(args.quantize, calibration)
+    if args.export:
+        model.export(args.export, args.batch_size)
+    if args.backend == 'onnxruntime' and not isinstance(model, CompiledModel):
+        # checked against the frozen PyTorch model, i.e. on the same learned graph as the one in the ONNX file
+        torch.manual_seed(0)
+        frozen = model.export(f"{args.output_path}/model.onnx", args.batch_size)
+        session = CompiledModel(f"{args.output_path}/model.onnx", device, args.ort_threads)
+        X = data.test[0][:args.batch_size].to(device).unsqueeze(1).transpose(2, 3)
+        with torch.no_grad():
+            error = (frozen(X) - session(X)).abs().max().item()
+        print(f"onnxruntime against PyTorch | max abs difference {error}")
+        if not error <= args.ort_tolerance:
+            raise RuntimeError(f'onnxruntime differs from PyTorch by {error}, more than {args.ort_tolerance}')
+        model = evaluated = session
 
-    vtest_acc, vtest_rae, vtest_corr, _, _ = evaluate(data, data.valid[0], data.valid[1], model, eval_mse_loss,
+    vtest_acc, vtest_rae, vtest_corr, _, _ = evaluate(data, data.valid[0], data.valid[1], evaluated, eval_mse_loss,
                                                       eval_l1_loss, args.batch_size)
-    test_acc, test_rae, test_corr, predicted_output, actual_output = evaluate(data, data.test[0], data.test[1], model,
-                                                                              eval_mse_loss, eval_l1_loss,
+    test_start_time = time.time()
+    test_acc, test_rae, test_corr, predicted_output, actual_output = evaluate(data, data.test[0], data.test[1],
+                                                                              evaluated, eval_mse_loss, eval_l1_loss,
                                                                               args.batch_size)
+    test_time = time.time() - test_start_time
     print(f"Final Test RSE {test_acc} | Test RAE {test_rae} | Test Correlation {test_corr}")
+    if args.quantize:
+        print(f"int8 {args.quantize} against fp32 | RSE {test_acc - fp32_acc:+.6f} | RAE {test_rae - fp32_rae:+.6f} | "
+              f"Correlation {test_corr - fp32_corr:+.6f} | Test time {test_time:.2f}s against {fp32_time:.2f}s")
+        if not test_acc <= fp32_acc * (1 + args.quant_tolerance):
+            raise RuntimeError(f'int8 {args.quantize} test RSE {float(test_acc)} is more than '
+                               f'{args.quant_tolerance:.2%} above the fp32 test RSE {float(fp32_acc)}')
 
     ## Save all the results:
-    adjacency_matrix = model.gc(torch.arange(args.num_nodes).to(device))
-    adjacency_matrix = adjacency_matrix.data.cpu().numpy()
+    if not isinstance(model, CompiledModel):
+        adjacency_matrix = model.gc(torch.arange(args.num_nodes).to(device))
+        adjacency_matrix = adjacency_matrix.data.cpu().numpy()
+        np.save(f"{args.output_path}/adjacency_matrix", adjacency_matrix)
     result_dict = {"training_loss": all_batches_loss}
-    np.save(f"{args.output_path}/adjacency_matrix", adjacency_matrix)
     np.save(f"{args.output_path}/predicted_output", predicted_output)
     np.save(f"{args.output_path}/actual_output", actual_output)
     with open(F"{args.output_path}/result.json", "w") as outfile:
@@ -1,14 +1,32 @@
+import copy
+import json
+
+import torch.distributed as dist
+from torch.ao import quantization
+from torch.func import functional_call, stack_module_state, vmap
+from torch.ao.nn.quantized import dynamic as nnqd
+
 from layer import *
 import numpy as np
 
 
 class MTGNN_Model(nn.Module):
-    def __init__(self, gcn_true, buildA_true, gcn_depth, num_nodes, device, predefined_A=None, static_feat=None, dropout=0.3, subgraph_size=20, node_dim=40, dilation_exponential=1, conv_channels=32, residual_channels=32, skip_channels=64, end_channels=128, seq_length=12, in_dim=2, out_dim=12, layers=3, propalpha=0.05, tanhalpha=3, layer_norm_affline=True):
+    # defaults for models pickled with torch.save before these options existed
+    propagation = 'auto'
+    fused_tconv = False
+    layout = 'nchw'
+    checkpoint_blocks = False
+    quantized = None
+    _plan_cache = None
+
+    def __init__(self, gcn_true, buildA_true, gcn_depth, num_nodes, device, predefined_A=None, static_feat=None, dropout=0.3, subgraph_size=20, node_dim=40, dilation_exponential=1, conv_channels=32, residual_channels=32, skip_channels=64, end_channels=128, seq_length=12, in_dim=2, out_dim=12, layers=3, propalpha=0.05, tanhalpha=3, layer_norm_affline=True, propagation='auto', gc_block_size=None, gc_ann_clusters=None, gc_ann_probe=2, gc_ann_refresh=100, fused_tconv=False, layout='nchw', checkpoint_blocks=False):
         super(MTGNN_Model, self).__init__()
         self.gcn_true = gcn_true
         self.buildA_true = buildA_true
         self.num_nodes = num_nodes
         self.dropout = dropout
+        # 'dense', 'sparse' or 'auto' (pick by graph size and k, see use_sparse_prop)
+        self.propagation = propagation
         self.predefined_A = predefined_A
         if predefined_A:
             self.predefined_A = np.loadtxt(open(predefined_A), delimiter=',')
@@ -16,6 +34,14 @@ class MTGNN_Model(nn.Module):
         ## Temporal Convolution
         self.filter_convs = nn.ModuleList()
         self.gate_convs = nn.ModuleList()
+        # filter and gate as one fused_inception per layer, see fuse_temporal_convs
+        self.fused_tconv = fused_tconv
+        self.gated_convs = nn.ModuleList()
+        # 'nchw' or 'node_major', which runs the layers on (N, B, C, T) tensors so that graph propagation is one
+        # matmul over a view and the temporal convolutions are conv1d over (N*B, C, T), with the same parameters
+        self.layout = layout
+        # recompute each residual block in the backward instead of storing its activations, see _layers
+        self.checkpoint_blocks = checkpoint_blocks
 
         ## Residual Convolution
         self.residual_convs = nn.ModuleList()
@@ -36,7 +62,9 @@ class MTGNN_Model(nn.Module):
                                     kernel_size=(1, 1))
 
         ## Graph learning layer
-        self.gc = graph_constructor(num_nodes, subgraph_size, node_dim, device, alpha=tanhalpha, static_feat=static_feat)
+        self.gc = graph_constructor(num_nodes, subgraph_size, node_dim, device, alpha=tanhalpha, static_feat=static_feat,
+                                   block_size=gc_block_size, ann_clusters=gc_ann_clusters, ann_probe=gc_ann_probe,
+                                   ann_refresh=gc_ann_refresh)
 
         self.seq_length = seq_length
         kernel_size = 7
@@ -58,8 +86,11 @@ class MTGNN_Model(nn.Module):
                     rf_size_j = rf_size_i+j*(kernel_size-1)
 
                 ## Temporal LAyers
-                self.filter_convs.append(dilated_inception(residual_channels, conv_channels, dilation_factor=new_dilation))
-                self.gate_convs.append(dilated_inception(residual_channels, conv_channels, dilation_factor=new_dilation))
+                if self.fused_tconv:
+                    self.gated_convs.append(fused_inception(residual_channels, conv_channels, dilation_factor=new_dilation))
+                else:
+                    self.filter_convs.append(dilated_inception(residual_channels, conv_channels, dilation_factor=new_dilation))
+                    self.gate_convs.append(dilated_inception(residual_channels, conv_channels, dilation_factor=new_dilation))
 
                 ## Residual conv
                 self.residual_convs.append(nn.Conv2d(in_channels=conv_channels,
@@ -108,50 +139,413 @@ class MTGNN_Model(nn.Module):
 
 
         self.idx = torch.arange(self.num_nodes).to(device)
+        self._plan_cache = None
+
+    def fuse_temporal_convs(self):
+        """
+        Converts a model built (or trained and saved) with separate filter/gate dilated_inception layers to
+        fused_inception layers in place, e.g. right after torch.load of an existing checkpoint.
+        """
+        if self.fused_tconv:
+            return self
+        self.gated_convs = nn.ModuleList([fused_inception.from_inception(f, g)
+                                          for f, g in zip(self.filter_convs, self.gate_convs)])
+        self.filter_convs = nn.ModuleList()
+        self.gate_convs = nn.ModuleList()
+        self.fused_tconv = True
+        return self
+
+    def quantize(self, mode='static', calibration=None):
+        """
+        Post-training int8 quantization in place, for CPU inference. Every convolution but start_conv is quantized:
+        the 1x1 `linear` convs of mixprop, the skip, residual and end convs and the dilated temporal convs. `static`
+        also quantizes their inputs with ranges observed while running the model on `calibration`, an iterable of
+        input batches, `dynamic` only quantizes the weights and picks the input range on every call. Dynamic mode
+        keeps end_conv_1 and end_conv_2 in fp32: their inputs are post-ReLU, which the dynamic int8 conv kernels
+        get badly wrong (most outputs collapse to 0).
+        """
+        if mode not in ['static', 'dynamic']:
+            raise ValueError('unknown quantization mode ' + mode)
+        if self.layout != 'nchw':
+            raise ValueError('int8 quantization needs the nchw layout')
+        if mode == 'static' and calibration is None:
+            raise ValueError('static quantization needs calibration batches')
+        engines = torch.backends.quantized.supported_engines
+        torch.backends.quantized.engine = next(e for e in ['x86', 'fbgemm', 'qnnpack'] if e in engines)
+        self.eval()
+        convs = [(parent, name, child) for parent in self.modules() if not isinstance(parent, quant_conv)
+                 for name, child in parent.named_children()
+                 if isinstance(child, nn.Conv2d) and child is not self.start_conv]
+        if mode == 'dynamic':
+            convs = [(parent, name, conv) for parent, name, conv in convs
+                     if conv is not self.end_conv_1 and conv is not self.end_conv_2]
+        for parent, name, conv in convs:
+            if isinstance(parent, fused_inception):
+                with torch.no_grad():
+                    conv.weight.mul_(parent.mask)
+            setattr(parent, name, quant_conv(conv))
+        wrappers = [name for name, m in self.named_modules() if isinstance(m, quant_conv)]
+        if mode == 'dynamic':
+            quantization.quantize_dynamic(self, {name + '.conv': quantization.default_dynamic_qconfig
+                                                 for name in wrappers},
+                                          mapping={nn.Conv2d: nnqd.Conv2d}, inplace=True)
+        else:
+            qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+            for name in wrappers:
+                self.get_submodule(name).qconfig = qconfig
+            quantization.prepare(self, inplace=True)
+            with torch.no_grad():
+                for x in calibration:
+                    self(x)
+            quantization.convert(self, inplace=True)
+        self.quantized = mode
+        return self
+
+    def train(self, mode=True):
+        # a fresh eval() or train() always rebuilds the graph, see graph_plan
+        self._plan_cache = None
+        return super(MTGNN_Model, self).train(mode)
+
+    def __getstate__(self):
+        # the cached plan is keyed on data pointers of this process, it is never saved with the model
+        state = self.__dict__.copy()
+        state['_plan_cache'] = None
+        return state
+
+    def _graph_version(self):
+        return tuple((p.data_ptr(), p._version) for p in self.gc.parameters())
+
+    def graph_plan(self, idx=None, device=None):
+        """
+        Propagation plan for the learned (or predefined) graph. In eval mode without autograd the full graph is
+        cached and reused across batches until a graph constructor parameter is replaced or updated in place
+        (optimizer step, load_state_dict), which bumps the version the cache is keyed on.
+        """
+        if not self.buildA_true:
+            adp = torch.as_tensor(self.predefined_A, dtype=torch.float32, device=device)
+            return prop_plan(adp)
+        cache = idx is None and not self.training and not torch.is_grad_enabled()
+        if cache:
+            version = self._graph_version()
+            if self._plan_cache is not None and self._plan_cache[0] == version:
+                return self._plan_cache[1]
+        if idx is None:
+            idx = self.idx
+        if self.propagation == 'auto':
+            # the block-wise and ANN searches exist to keep the N x N scores out of memory, so the graph they select
+            # is propagated as the sparse (N, k) adjacency and never scattered into a dense one
+            sparse = bool(self.gc.block_size) or self.gc.ann is not None or use_sparse_prop(idx.size(0), self.gc.k)
+        else:
+            sparse = self.propagation == 'sparse'
+        # the learned graph (scores, top-k and normalization) stays in fp32 under a bfloat16 autocast region
+        with full_precision(idx):
+            plan = prop_plan(self.gc(idx, sparse=sparse))
+        if cache:
+            self._plan_cache = (version, plan)
+        return plan
+
 
+    def export(self, path, batch_size):
+        """
+        Writes an inference artifact specialized to (batch_size, num_nodes, seq_length) with the learned graph frozen,
+        loadable without the model classes through util.CompiledModel: a frozen TorchScript trace, a torch.export
+        program when the path ends in .pt2, or an ONNX graph for onnxruntime when it ends in .onnx.
+        """
+        # torch.export and ONNX can not serialize sparse constants, their graphs always take the dense adjacency
+        frozen = MTGNN_Frozen(self, dense=path.endswith(('.pt2', '.onnx'))).eval()
+        example = torch.zeros(batch_size, self.start_conv.in_channels, self.num_nodes, self.seq_length,
+                              device=self.idx.device)
+        meta = json.dumps({'batch_size': batch_size, 'num_nodes': self.num_nodes, 'seq_length': self.seq_length})
+        with torch.no_grad():
+            if path.endswith('.pt2'):
+                torch.export.save(torch.export.export(frozen, (example,)), path, extra_files={'meta.json': meta})
+            elif path.endswith('.onnx'):
+                torch.onnx.export(frozen, (example,), path, input_names=['input'], output_names=['output'])
+            else:
+                traced = torch.jit.freeze(torch.jit.trace(frozen, example))
+                torch.jit.save(traced, path, _extra_files={'meta.json': meta})
+        return frozen
 
     def forward(self, input, idx=None):
+        plan = None
+        if self.gcn_true:
+            plan = self.graph_plan(idx, input.device)
+        return self._forward(input, plan, idx)
+
+    def _forward(self, input, plan, idx=None):
         seq_len = input.size(3)
         assert seq_len==self.seq_length, 'input sequence length not equal to preset sequence length'
 
         if self.seq_length<self.receptive_field:
             input = nn.functional.pad(input,(self.receptive_field-self.seq_length,0,0,0))
 
-        if self.gcn_true:
-            if self.buildA_true:
-                if idx is None:
-                    adp = self.gc(self.idx)
-                else:
-                    adp = self.gc(idx)
-            else:
-                adp = self.predefined_A
+        if self.layout == 'node_major':
+            input = input.permute(2, 0, 1, 3).contiguous()
+        x = self._conv(self.start_conv, input)
+        skip = self._conv(self.skip0, F.dropout(input, self.dropout, training=self.training))
+        x = self._layers(x, skip, plan, idx)
+        if self.layout == 'node_major':
+            x = x.permute(1, 2, 0, 3)
+        return x
+
+    def _conv(self, conv, x):
+        if self.layout == 'node_major':
+            return conv_node_major(conv, x)
+        return conv(x)
 
-        x = self.start_conv(input)
-        skip = self.skip0(F.dropout(input, self.dropout, training=self.training))
-        for i in range(self.layers):
-            residual = x
-            filter = self.filter_convs[i](x)
+    def _temporal(self, i, x):
+        node_major = self.layout == 'node_major'
+        if self.fused_tconv:
+            x = self.gated_convs[i].forward_node_major(x) if node_major else self.gated_convs[i](x)
+        else:
+            filter = self.filter_convs[i].forward_node_major(x) if node_major else self.filter_convs[i](x)
             filter = torch.tanh(filter)
-            gate = self.gate_convs[i](x)
+            gate = self.gate_convs[i].forward_node_major(x) if node_major else self.gate_convs[i](x)
             gate = torch.sigmoid(gate)
             x = filter * gate
-            x = F.dropout(x, self.dropout, training=self.training)
-            s = x
-            s = self.skip_convs[i](s)
-            skip = s + skip
-            if self.gcn_true:
-                x = self.gconv1[i](x, adp)+self.gconv2[i](x, adp.transpose(1,0))
-            else:
-                x = self.residual_convs[i](x)
+        return F.dropout(x, self.dropout, training=self.training)
+
+    def _graph(self, i, x, plan):
+        if self.gcn_true:
+            if isinstance(plan, node_partition):
+                return self.gconv1[i].forward_partitioned(x, plan.out) + \
+                    self.gconv2[i].forward_partitioned(x, plan.inn)
+            if self.layout == 'node_major':
+                return self.gconv1[i].forward_node_major(x, plan.out, True) + \
+                    self.gconv2[i].forward_node_major(x, plan.inn, True)
+            return self.gconv1[i](x, plan.out, True)+self.gconv2[i](x, plan.inn, True)
+        return self._conv(self.residual_convs[i], x)
 
-            x = x + residual[:, :, :, -x.size(3):]
-            if idx is None:
-                x = self.norm[i](x,self.idx)
+    def _layers(self, x, skip, plan, idx, first=0):
+        if idx is None:
+            idx = self.idx
+        checkpointed = self.checkpoint_blocks and self.training and torch.is_grad_enabled()
+        for i in range(first, self.layers):
+            if checkpointed:
+                # only the block inputs are kept, the inception, mixprop hop and skip activations are recomputed
+                x, skip = checkpoint(self._block, i, x, skip, plan, idx, use_reentrant=False)
             else:
-                x = self.norm[i](x,idx)
+                x, skip = self._block(i, x, skip, plan, idx)
 
-        skip = self.skipE(x) + skip
+        skip = self._conv(self.skipE, x) + skip
         x = F.relu(skip)
-        x = F.relu(self.end_conv_1(x))
-        x = self.end_conv_2(x)
+        x = F.relu(self._conv(self.end_conv_1, x))
+        x = self._conv(self.end_conv_2, x)
         return x
+
+    def _block(self, i, x, skip, plan, idx):
+        residual = x
+        x = self._temporal(i, x)
+        s = x
+        s = self._conv(self.skip_convs[i], s)
+        skip = s + skip
+        x = self._graph(i, x, plan)
+
+        x = x + residual[:, :, :, -x.size(3):]
+        if isinstance(plan, node_partition):
+            x = self.norm[i].forward_partitioned(x, idx)
+        elif self.layout == 'node_major':
+            x = self.norm[i].forward_node_major(x, idx)
+        else:
+            x = self.norm[i](x, idx)
+        return x, skip
+
+
+class MTGNN_Frozen(nn.Module):
+    """
+    Inference-only view of a trained MTGNN_Model with the propagation plan of the full learned graph computed once
+    and kept as buffers, so that a trace or torch.export of it records a straight-line program without the graph
+    construction, the adjacency normalization or any Python branching. It is its own plan for MTGNN_Model._forward.
+    """
+
+    def __init__(self, model, dense=False):
+        super(MTGNN_Frozen, self).__init__()
+        self.model = model.eval()
+        plan = None
+        if model.gcn_true:
+            with torch.no_grad():
+                plan = model.graph_plan(None, model.idx.device)
+        for name in ['adj', 'out', 'inn']:
+            buffer = getattr(plan, name) if plan is not None else None
+            if dense and buffer is not None and buffer.is_sparse:
+                buffer = buffer.to_dense()
+            self.register_buffer(name, buffer)
+
+    def forward(self, input):
+        return self.model._forward(input, self if self.model.gcn_true else None)
+
+
+class MTGNN_NodeParallel(nn.Module):
+    """
+    Node-partitioned execution of an MTGNN_Model over the ranks of the default process group, for graphs whose
+    activations do not fit one device. The parameters are small and replicated, but every rank computes the
+    activations of its own contiguous slice of the nodes only: its rows of the top-k graph, shared as (N, k)
+    neighbour lists, and per mixprop hop the halo rows of other ranks its adjacency reaches (halo_plan). The
+    LayerNorm statistics are all-reduced. forward returns the output of all nodes on every rank, so losses and
+    metrics are computed as for the plain model; after the backward every rank holds the gradient of the paths
+    through its own nodes, which all_reduce_grads sums before the optimizer step. With check_batches every forward
+    first verifies that all ranks got the same batch and node set, an extra all_gather per step meant for debugging.
+    """
+
+    def __init__(self, model, check_batches=False):
+        super(MTGNN_NodeParallel, self).__init__()
+        if not (model.gcn_true and model.buildA_true) or model.layout != 'nchw':
+            raise ValueError("MTGNN_NodeParallel needs a learned graph and layout='nchw'")
+        self.model = model
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.check_batches = check_batches
+        for tensor in model.state_dict().values():
+            dist.broadcast(tensor, 0)
+
+    def forward(self, input, idx=None):
+        if idx is None:
+            idx = self.model.idx
+        if self.check_batches:
+            self._check_replicated(input, idx)
+        sizes = [len(part) for part in torch.arange(idx.size(0)).tensor_split(self.world_size)]
+        bounds = [(sum(sizes[:rank]), sum(sizes[:rank + 1])) for rank in range(self.world_size)]
+        start, end = bounds[self.rank]
+        cols, values = self.model.gc.neighbours(idx, start, end)
+        plan = node_partition(gather_rows(cols, sizes), gather_rows(values, sizes, reduce_grad=True), bounds,
+                              self.rank)
+        output = self.model._forward(input[:, :, start:end], plan, idx[start:end])
+        return gather_rows(output.transpose(0, 2), sizes).transpose(0, 2)
+
+    def _check_replicated(self, input, idx):
+        # every rank has to run the same batch on the same nodes, or the gathers would mix slices of different ones
+        weights = torch.arange(1, input.numel() + 1, dtype=torch.float64, device=input.device)
+        digest = torch.stack([(input.double().flatten() * weights).sum(), (idx.double() * (idx + 1)).sum()])
+        digests = [torch.empty_like(digest) for _ in range(self.world_size)]
+        dist.all_gather(digests, digest)
+        if any(not torch.equal(digests[0], other) for other in digests[1:]):
+            raise RuntimeError('node-partitioned ranks got different batches or node sets, their RNG streams differ')
+
+    def all_reduce_grads(self):
+        for p in self.model.parameters():
+            if p.grad is not None:
+                dist.all_reduce(p.grad)
+
+
+class MTGNN_Ensemble(nn.Module):
+    """
+    Independently initialized MTGNN_Models trained as one, for multi-seed variance studies: their parameters are
+    stacked along a leading member dimension (torch.func.stack_module_state) and forward vmaps the functional model
+    over it, so the members share the batches and run as batched kernels in one forward and backward. An optimizer
+    over the stacked parameters updates every member as its own (Adam and weight decay act elementwise).
+    forward(input, idx) returns (members, batch, out_dim, N, 1). The graph is always propagated dense, the sparse
+    kernels can not be vmapped.
+    """
+
+    def __init__(self, models):
+        super(MTGNN_Ensemble, self).__init__()
+        for model in models:
+            if model.gc.ann is not None or model.checkpoint_blocks or model.quantized:
+                raise ValueError('MTGNN_Ensemble needs models without gc_ann_clusters, checkpoint_blocks or '
+                                 'quantization')
+        params, buffers = stack_module_state(models)
+        self.names = list(params)
+        self.stacked = nn.ParameterList([nn.Parameter(params[name].detach()) for name in self.names])
+        self.buffers_ = buffers
+        # not a submodule: its own parameters are never used, functional_call swaps the stacked ones in
+        template = copy.deepcopy(models[0])
+        self.propagation = template.propagation
+        template.propagation = 'dense'
+        object.__setattr__(self, 'template', template)
+
+    def __len__(self):
+        return self.stacked[0].size(0)
+
+    def train(self, mode=True):
+        self.template.train(mode)
+        return super(MTGNN_Ensemble, self).train(mode)
+
+    def forward(self, input, idx=None):
+        # an explicit idx also keeps the cache of graph_plan, which would hold one member's graph, out of the vmap
+        if idx is None:
+            idx = self.template.idx
+
+        def member(params, buffers):
+            return functional_call(self.template, (params, buffers), (input, idx))
+
+        return vmap(member, randomness='different')(dict(zip(self.names, self.stacked)), self.buffers_)
+
+    def member(self, i):
+        # a plain MTGNN_Model with the current parameters of member i, e.g. for a checkpoint
+        model = copy.deepcopy(self.template)
+        model.propagation = self.propagation
+        state = {name: p[i].detach().clone() for name, p in zip(self.names, self.stacked)}
+        state.update({name: b[i].clone() for name, b in self.buffers_.items()})
+        model.load_state_dict(state)
+        return model
+
+
+class MTGNN_Stream(object):
+    """
+    Tick-by-tick inference for a trained MTGNN_Model over the full graph, for a new observation every few minutes.
+    The learned graph, the input window, the start_conv outputs and the first layer's gated temporal and graph
+    convolution columns are kept between ticks, so a tick only computes the first layer for the newest column (and,
+    while the window is zero padded to the receptive field, the few columns that read the padding edge).
+
+    Unlike fast-WaveNet queues this can not be carried into the later layers: the LayerNorm after every layer
+    normalizes over the whole window, so each tick changes all of its outputs and the layers from the second on
+    are recomputed over the window, as is the window-length skip convolution of the first layer.
+    """
+
+    def __init__(self, model, history):
+        # history: (batch, in_dim, num_nodes, seq_length), the last seq_length observations
+        if model.layout != 'nchw':
+            raise ValueError("MTGNN_Stream needs a model with layout='nchw'")
+        self.model = model.eval()
+        m = self.model
+        self.pad = max(m.receptive_field - m.seq_length, 0)
+        if m.fused_tconv:
+            conv = m.gated_convs[0].tconv
+        else:
+            conv = m.filter_convs[0].tconv[-1]
+        self.span = (conv.kernel_size[1] - 1) * conv.dilation[1] + 1
+        with torch.no_grad():
+            self.plan = m.graph_plan(None, history.device) if m.gcn_true else None
+            self.input = F.pad(history, (self.pad, 0, 0, 0))
+            self.start = m.start_conv(self.input)
+            self.gated, self.hidden = self._first_layer(self.start)
+
+    def _first_layer(self, start):
+        m = self.model
+        gated = m._temporal(0, start)
+        hidden = m._graph(0, gated, self.plan) + start[:, :, :, -gated.size(3):]
+        return gated, hidden
+
+    def _output(self):
+        m = self.model
+        skip = m.skip0(self.input) + m.skip_convs[0](self.gated)
+        x = m.norm[0](self.hidden, m.idx)
+        return m._layers(x, skip, self.plan, None, first=1)
+
+    def forecast(self):
+        with torch.no_grad():
+            return self._output()
+
+    def step(self, obs):
+        """
+        Appends one observation of shape (batch, in_dim, num_nodes) and returns the forecast for the new window,
+        equal to model(window) on the last seq_length observations.
+        """
+        m = self.model
+        with torch.no_grad():
+            obs = obs.unsqueeze(3)
+            self.input = torch.cat([self.input[:, :, :, 1:], obs], 3)
+            self.start = torch.cat([self.start[:, :, :, 1:], m.start_conv(obs)], 3)
+            gated, hidden = self._first_layer(self.start[:, :, :, -self.span:])
+            self.gated = torch.cat([self.gated[:, :, :, 1:], gated], 3)
+            self.hidden = torch.cat([self.hidden[:, :, :, 1:], hidden], 3)
+            if self.pad > 0:
+                # the padding does not slide with the window, restore its last column and the outputs that read it
+                self.input[:, :, :, self.pad - 1] = 0
+                self.start[:, :, :, self.pad - 1:self.pad] = m.start_conv(self.input[:, :, :, self.pad - 1:self.pad])
+                lo = max(self.pad - self.span, 0)
+                hi = min(self.pad, self.gated.size(3))
+                gated, hidden = self._first_layer(self.start[:, :, :, lo:hi + self.span - 1])
+                self.gated[:, :, :, lo:hi] = gated
+                self.hidden[:, :, :, lo:hi] = hidden
+            return self._output()
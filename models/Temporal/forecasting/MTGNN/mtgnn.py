@@ -1,59 +1,52 @@
 import argparse
 import json
-import math
 import os
 import time
+import traceback
 from pathlib import Path
 
 import matplotlib.pyplot as plt
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
 
-from model import MTGNN_Model
+from model import MTGNN_Ensemble, MTGNN_Model, MTGNN_NodeParallel
 from trainer import Optim
 from util import *
 
 
+def is_main_process():
+    # checkpoints, evaluation and logging only happen on rank 0 of a distributed run
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
 def evaluate(data, X, Y, model, eval_mse_loss, eval_l1_loss, batch_size):
+    # an MTGNN_Ensemble is evaluated for all its members in one pass and gets the list of their results
     model.eval()
-    total_loss = 0
-    total_loss_l1 = 0
-    n_samples = 0
-    predicted_label = None
-    test = None
+    members = len(model) if isinstance(model, MTGNN_Ensemble) else 0
+    metrics = [StreamingMetrics(len(X), data.m, data.device) for _ in range(members or 1)]
 
-    for X, Y in data.get_batches(X, Y, batch_size, False):
+    for X, Y in data.get_batches(X, Y, batch_size, False, prefetch=args.prefetch):
         X = torch.unsqueeze(X, dim=1)
         X = X.transpose(2, 3)
-        with torch.no_grad():
+        with torch.no_grad(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.bf16):
             output = model(X)
-        output = torch.squeeze(output)
-        if len(output.shape) == 1:
-            output = output.unsqueeze(dim=0)
-        if predicted_label is None:
-            predicted_label = output
-            test = Y
+        if members:
+            outputs = output.float().squeeze(-1).squeeze(-2)
         else:
-            predicted_label = torch.cat((predicted_label, output))
-            test = torch.cat((test, Y))
+            output = torch.squeeze(output.float())
+            if len(output.shape) == 1:
+                output = output.unsqueeze(dim=0)
+            outputs = [output]
 
-        scale = data.scale.expand(output.size(0), data.m)
-        total_loss += eval_mse_loss(output * scale, Y * scale).item()
-        total_loss_l1 += eval_l1_loss(output * scale, Y * scale).item()
-        n_samples += (output.size(0) * data.m)
+        scale = data.scale.expand(Y.size(0), data.m)
+        for member_metrics, output in zip(metrics, outputs):
+            member_metrics.update(output, Y, eval_mse_loss(output * scale, Y * scale),
+                                  eval_l1_loss(output * scale, Y * scale))
 
-    rse = math.sqrt(total_loss / n_samples) / data.rse
-    rae = (total_loss_l1 / n_samples) / data.rae
-
-    predicted_label = predicted_label.data.cpu().numpy()
-    actual_label = test.data.cpu().numpy()
-    sigma_p = (predicted_label).std(axis=0)
-    sigma_g = (actual_label).std(axis=0)
-    mean_p = predicted_label.mean(axis=0)
-    mean_g = actual_label.mean(axis=0)
-    index = (sigma_g != 0)
-    correlation = ((predicted_label - mean_p) * (actual_label - mean_g)).mean(axis=0) / (sigma_p * sigma_g)
-    correlation = (correlation[index]).mean()
-    return rse, rae, correlation, predicted_label, actual_label
+    results = [member_metrics.result(data.rse, data.rae) for member_metrics in metrics]
+    return results if members else results[0]
 
 
 def train(data, X, Y, model, loss_function, optimizer, batch_size):
@@ -61,39 +54,143 @@ def train(data, X, Y, model, loss_function, optimizer, batch_size):
     total_loss = []
     n_samples = 0
     batch = 0
-    for X, Y in data.get_batches(X, Y, batch_size, True):
+    # data parallel ranks train on shards of the batches, node parallel ranks all see every batch
+    data_parallel = dist.is_initialized() and args.parallel == 'data'
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if data_parallel else (0, 1)
+    for X, Y in data.get_batches(X, Y, batch_size, True, prefetch=args.prefetch, rank=rank, world_size=world_size,
+                                 seeded=dist.is_initialized()):
         model.zero_grad()
         X = torch.unsqueeze(X, dim=1)
         X = X.transpose(2, 3)
         if batch % args.step_size == 0:
             perm = np.random.permutation(range(args.num_nodes))
-        num_sub = int(args.num_nodes / args.num_split)
 
         for j in range(args.num_split):
-            if j != args.num_split - 1:
-                id = perm[j * num_sub:(j + 1) * num_sub]
-            else:
-                id = perm[j * num_sub:]
-            id = torch.tensor(id).to(device)
-            tx = X[:, :, id, :]
-            ty = Y[:, id]
-            output = model(tx, id)
-            output = torch.squeeze(output)
-            scale = data.scale.expand(output.size(0), data.m)
-            scale = scale[:, id]
-            loss = loss_function(output * scale, ty * scale)
-            loss.backward()
-            total_loss.append(loss.item() / (output.size(0) * data.m))
-            n_samples += (output.size(0) * data.m)
-            optimizer.step()
-
-        if batch % 100 == 0:
-            loss = loss.item() / (output.size(0) * data.m)
-            print(f"Batch:{batch} | loss: {loss}")
+            loss, batch_samples = train_split(data, X, Y, split_nodes(perm, j), model, loss_function, optimizer)
+            total_loss.append(loss / batch_samples)
+            n_samples += batch_samples
+
+        if batch % 100 == 0 and is_main_process():
+            print(f"Batch:{batch} | loss: {loss / batch_samples}")
         batch += 1
+    if is_main_process():
+        print(f"Time spent waiting on data: {data.stall_time}s")
     average_loss = sum(total_loss) / n_samples
+    if world_size > 1:
+        # loss over the shards of all ranks
+        totals = torch.tensor([sum(total_loss), n_samples], dtype=torch.float64)
+        dist.all_reduce(totals)
+        average_loss = (totals[0] / totals[1]).item()
     return average_loss, total_loss
 
+def split_nodes(perm, j):
+    # nodes of the j-th of the num_split subgraphs of the permutation perm
+    num_sub = int(args.num_nodes / args.num_split)
+    if j != args.num_split - 1:
+        id = perm[j * num_sub:(j + 1) * num_sub]
+    else:
+        id = perm[j * num_sub:]
+    return torch.tensor(id).to(device)
+
+
+def train_split(data, X, Y, id, model, loss_function, optimizer):
+    # one step on the subgraph id of the batch, returns the summed loss and the number of predicted values, per
+    # member for an MTGNN_Ensemble, whose members' losses are summed into one backward
+    tx = X[:, :, id, :]
+    ty = Y[:, id]
+    with torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.bf16):
+        output = model(tx, id)
+    members = 1
+    if isinstance(model, MTGNN_Ensemble):
+        members = len(model)
+        output = output.float().squeeze(-1).squeeze(-2)
+    else:
+        output = torch.squeeze(output.float())
+    scale = data.scale.expand(ty.size(0), data.m)
+    scale = scale[:, id]
+    loss = loss_function(output * scale, (ty * scale).expand_as(output))
+    loss.backward()
+    if isinstance(model, MTGNN_NodeParallel):
+        model.all_reduce_grads()
+    optimizer.step()
+    return loss.item() / members, ty.size(0) * data.m
+
+
+def split_worker(j, data, model, loss_function, tasks, results):
+    # trains the j-th subgraph of every batch of an epoch per seed it gets, with its own optimizer
+    torch.set_num_threads(max(1, torch.get_num_threads() // args.num_split))
+    optimizer = Optim(model.parameters(), args.optim, args.lr, args.clip, lr_decay=args.weight_decay)
+    model.train()
+    try:
+        for seed in iter(tasks.get, None):
+            # the same seed in every worker gives all of them the same batches and node permutations
+            torch.manual_seed(seed)
+            np.random.seed(seed)
+            for batch, (X, Y) in enumerate(data.get_batches(data.train[0], data.train[1], args.batch_size, True,
+                                                            prefetch=args.prefetch)):
+                model.zero_grad()
+                X = torch.unsqueeze(X, dim=1)
+                X = X.transpose(2, 3)
+                if batch % args.step_size == 0:
+                    perm = np.random.permutation(range(args.num_nodes))
+                results.put((j, batch) + train_split(data, X, Y, split_nodes(perm, j), model, loss_function,
+                                                     optimizer))
+            results.put((j, None, data.stall_time, 0))
+    except Exception:
+        results.put((j, None, traceback.format_exc(), 0))
+
+
+class SplitWorkers(object):
+    """
+    Hogwild training of the num_split subgraphs: one process per subgraph, forked once per training run, each
+    stepping its own optimizer on the parameters it shares with the main process through shared memory, without
+    locks. The subgraphs of a batch are trained concurrently instead of one after another, so splitting the graph
+    also raises the throughput. The optimizer state is per process, as in the Hogwild setting of the subgraphs
+    running sequentially on one optimizer. Evaluation and checkpoints in the main process see the shared parameters.
+    The workers are forked, so the model has to be on the CPU.
+    """
+
+    def __init__(self, data, model, loss_function):
+        model.share_memory()
+        context = mp.get_context('fork')
+        self.tasks = [context.SimpleQueue() for _ in range(args.num_split)]
+        self.results = context.SimpleQueue()
+        self.processes = [context.Process(target=split_worker, args=(j, data, model, loss_function, tasks,
+                                                                     self.results), daemon=True)
+                          for j, tasks in enumerate(self.tasks)]
+        for process in self.processes:
+            process.start()
+
+    def train(self, data):
+        seed = torch.randint(2 ** 31, (1,)).item()
+        for tasks in self.tasks:
+            tasks.put(seed)
+        losses = {}
+        stall_time = 0.
+        running = args.num_split
+        while running:
+            j, batch, loss, batch_samples = self.results.get()
+            if batch is None:
+                if isinstance(loss, str):
+                    raise RuntimeError(f'subgraph worker {j} failed:\n{loss}')
+                stall_time = max(stall_time, loss)
+                running -= 1
+                continue
+            losses[batch, j] = (loss, batch_samples)
+            if batch % 100 == 0 and j == args.num_split - 1:
+                print(f"Batch:{batch} | loss: {loss / batch_samples}")
+        print(f"Time spent waiting on data: {stall_time}s")
+        total_loss = [loss / batch_samples for _, (loss, batch_samples) in sorted(losses.items())]
+        average_loss = sum(total_loss) / sum(batch_samples for loss, batch_samples in losses.values())
+        return average_loss, total_loss
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+
 parser = argparse.ArgumentParser(description='PyTorch Time series forecasting')
 parser.add_argument('--data', type=str, default='./data/solar.txt',
                     help='location of the data file')
@@ -106,10 +203,30 @@ parser.add_argument('--output_path', type=str, default='results',
 parser.add_argument('--optim', type=str, default='adam')
 parser.add_argument('--L1Loss', type=bool, default=True)
 parser.add_argument('--normalize', type=int, default=2)
+parser.add_argument('--streaming', action='store_true',
+                    help='fit the scalers chunk by chunk and normalize into a memory-mapped store, as without it')
+parser.add_argument('--chunk_rows', type=int, default=100000, help='rows per chunk in streaming mode')
 parser.add_argument('--device', type=str, default='cuda:1', help='')
 parser.add_argument('--gcn_true', type=bool, default=True, help='whether to add graph convolution layer')
 parser.add_argument('--buildA_true', type=bool, default=True, help='whether to construct adaptive adjacency matrix')
 parser.add_argument('--pre_defined_graph_path', type=str, default=None, help='Pre Defined Graph path')
+parser.add_argument('--propagation', type=str, default='auto', choices=['auto', 'dense', 'sparse'],
+                    help='graph propagation with the dense or the sparse k-NN adjacency, auto picks by size and is '
+                         'sparse with the block-wise or ANN graph search')
+parser.add_argument('--gc_block_size', type=int, default=0,
+                    help='build the k-NN graph in blocks of this many nodes instead of the full N x N scores, 0 is off')
+parser.add_argument('--gc_ann_clusters', type=int, default=0,
+                    help='search the k-NN graph in an inverted-file index with this many clusters, 0 is exact')
+parser.add_argument('--gc_ann_probe', type=int, default=2, help='clusters scored per node in the ANN index')
+parser.add_argument('--gc_ann_refresh', type=int, default=100, help='forward passes between re-fits of the ANN index')
+parser.add_argument('--fused_tconv', action='store_true',
+                    help='run the filter and gate dilated inception convolutions as one fused convolution')
+parser.add_argument('--layout', type=str, default='nchw', choices=['nchw', 'node_major'],
+                    help='activation layout, node_major makes graph propagation a single matmul')
+parser.add_argument('--checkpoint_blocks', action='store_true',
+                    help='recompute every residual block in the backward instead of storing its activations')
+parser.add_argument('--bf16', action='store_true',
+                    help='bfloat16 autocast for the model forward, LayerNorm and the graph normalization stay fp32')
 parser.add_argument('--gcn_depth', type=int, default=2, help='graph convolution depth')
 parser.add_argument('--num_nodes', type=int, default=137, help='number of nodes/variables')
 parser.add_argument('--dropout', type=float, default=0.3, help='dropout rate')
@@ -127,6 +244,7 @@ parser.add_argument('--horizon', type=int, default=3)
 parser.add_argument('--layers', type=int, default=5, help='number of layers')
 
 parser.add_argument('--batch_size', type=int, default=32, help='batch size')
+parser.add_argument('--prefetch', type=int, default=0, help='number of batches gathered ahead on a background thread')
 parser.add_argument('--lr', type=float, default=0.0001, help='learning rate')
 parser.add_argument('--weight_decay', type=float, default=0.00001, help='weight decay rate')
 
@@ -139,17 +257,35 @@ parser.add_argument('--epochs', type=int, default=1, help='')
 parser.add_argument('--num_split', type=int, default=1, help='number of splits for graphs')
 parser.add_argument('--step_size', type=int, default=100, help='step_size')
 parser.add_argument('--no_of_runs', type=int, default=1, help='No of times model has to run')
+parser.add_argument('--ensemble', action='store_true',
+                    help='train the no_of_runs models together as one vectorized ensemble over the same batches')
 parser.add_argument('--sample_data', type=int, default=0, help='Sample no of records to run for benchmark')
+parser.add_argument('--world_size', type=int, default=1,
+                    help='local processes for distributed training over gloo, batch_size is per process with --parallel data')
+parser.add_argument('--split_workers', action='store_true',
+                    help='train the num_split subgraphs of every batch concurrently in Hogwild worker processes, '
+                         'on the CPU only')
+parser.add_argument('--parallel', type=str, default='data', choices=['data', 'node'],
+                    help='with world_size > 1, split the batches over the processes or the nodes of the graph')
+parser.add_argument('--check_batches', action='store_true',
+                    help='with --parallel node, verify on every step that all ranks run the same batch (debugging)')
+parser.add_argument('--master_port', type=int, default=29500, help='port of the gloo rendezvous on localhost')
+parser.add_argument('--threads', type=int, default=0,
+                    help='torch threads per process, 0 splits the cores evenly over the world_size processes')
 
 args = parser.parse_args()
+if args.split_workers and args.world_size > 1:
+    parser.error('--split_workers trains in one process group of its own, it can not be combined with --world_size')
+if args.split_workers and torch.device(args.device).type != 'cpu':
+    # the workers are forked after the model is built, and CUDA can not be used again in a forked child
+    parser.error('--split_workers shares the model with forked workers, it needs --device cpu')
+if args.ensemble and (args.split_workers or args.world_size > 1):
+    parser.error('--ensemble runs in one process, it can not be combined with --split_workers or --world_size')
 device = torch.device(args.device)
-torch.set_num_threads(3)
+torch.set_num_threads(args.threads or max(1, os.cpu_count() // args.world_size))
 
 
-def main():
-    Path(args.output_path).mkdir(exist_ok=True)
-    data = DataLoader(args.data, 0.6, 0.2, device, args.horizon, args.seq_in_len, args.sample_data, args.normalize)
-
+def build_model():
     model = MTGNN_Model(args.gcn_true, args.buildA_true, args.gcn_depth, args.num_nodes,
                         device, predefined_A=args.pre_defined_graph_path, dropout=args.dropout, subgraph_size=args.subgraph_size,
                         node_dim=args.node_dim, dilation_exponential=args.dilation_exponential,
@@ -157,87 +293,217 @@ def main():
                         skip_channels=args.skip_channels, end_channels=args.end_channels,
                         seq_length=args.seq_in_len, in_dim=args.in_dim, out_dim=args.seq_out_len,
                         layers=args.layers, propalpha=args.propalpha, tanhalpha=args.tanhalpha,
-                        layer_norm_affline=False)
-    model = model.to(device)
+                        layer_norm_affline=False, propagation=args.propagation,
+                        gc_block_size=args.gc_block_size, gc_ann_clusters=args.gc_ann_clusters,
+                        gc_ann_probe=args.gc_ann_probe, gc_ann_refresh=args.gc_ann_refresh, layout=args.layout,
+                        fused_tconv=args.fused_tconv, checkpoint_blocks=args.checkpoint_blocks)
+    return model.to(device)
 
-    print('The receptive field size is', model.receptive_field)
-    model_parameters = sum([p.nelement() for p in model.parameters()])
-    print('Number of model parameters is', model_parameters, flush=True)
 
+def loss_functions():
+    # training loss, summed squared and absolute error for evaluation
     if args.L1Loss:
         train_loss_func = nn.L1Loss(size_average=False).to(device)
     else:
         train_loss_func = nn.MSELoss(size_average=False).to(device)
-    eval_mse_loss = nn.MSELoss(size_average=False).to(device)
-    eval_l1_loss = nn.L1Loss(size_average=False).to(device)
+    return train_loss_func, nn.MSELoss(size_average=False).to(device), nn.L1Loss(size_average=False).to(device)
+
+
+def save_results(model, predicted_output, actual_output, all_batches_loss):
+    adjacency_matrix = model.gc(torch.arange(args.num_nodes).to(device))
+    adjacency_matrix = adjacency_matrix.data.cpu().numpy()
+    result_dict = {"training_loss": all_batches_loss}
+    np.save(f"{args.output_path}/adjacency_matrix", adjacency_matrix)
+    np.save(f"{args.output_path}/predicted_output", predicted_output)
+    np.save(f"{args.output_path}/actual_output", actual_output)
+    with open(F"{args.output_path}/result.json", "w") as outfile:
+        json.dump(result_dict, outfile)
+    plt.plot(range(len(all_batches_loss)), all_batches_loss)
+    plt.savefig(f'{args.output_path}/train_loss.png')
+
+
+def main():
+    Path(args.output_path).mkdir(exist_ok=True)
+    data = DataLoader(args.data, 0.6, 0.2, device, args.horizon, args.seq_in_len, args.sample_data, args.normalize,
+                      streaming=args.streaming, chunk_rows=args.chunk_rows)
+
+    model = build_model()
+    # gradients are all-reduced in the backward of the wrapper, evaluation and checkpoints use the plain model
+    net = model
+    # node parallel ranks compute a slice of the nodes of every batch, so they all evaluate together
+    node_parallel = dist.is_initialized() and args.parallel == 'node'
+    if node_parallel:
+        net = MTGNN_NodeParallel(model, args.check_batches)
+    elif dist.is_initialized():
+        # some parameters never take part in the forward: residual_convs with graph convolution, the graph
+        # constructor with a predefined graph
+        net = DistributedDataParallel(model, find_unused_parameters=True)
+
+    if is_main_process():
+        print('The receptive field size is', model.receptive_field)
+        model_parameters = sum([p.nelement() for p in model.parameters()])
+        print('Number of model parameters is', model_parameters, flush=True)
+
+    train_loss_func, eval_mse_loss, eval_l1_loss = loss_functions()
 
     best_val = 10000000
-    optimizer = Optim(model.parameters(), args.optim, args.lr, args.clip, lr_decay=args.weight_decay)
+    optimizer = Optim(net.parameters(), args.optim, args.lr, args.clip, lr_decay=args.weight_decay)
     all_batches_loss = []
+    workers = SplitWorkers(data, model, train_loss_func) if args.split_workers else None
 
     # At any point you can hit Ctrl + C to break out of training early.
     try:
-        print('Training started')
+        if is_main_process():
+            print('Training started')
         for epoch in range(1, args.epochs + 1):
             epoch_start_time = time.time()
-            train_loss, batches_loss = train(data, data.train[0], data.train[1], model, train_loss_func, optimizer,
-                                             args.batch_size)
+            if workers is not None:
+                train_loss, batches_loss = workers.train(data)
+            else:
+                train_loss, batches_loss = train(data, data.train[0], data.train[1], net, train_loss_func, optimizer,
+                                                 args.batch_size)
             all_batches_loss += batches_loss
-            val_loss, val_rae, val_corr, _, _ = evaluate(data, data.valid[0], data.valid[1], model, eval_mse_loss,
+            if not (is_main_process() or node_parallel):
+                continue
+            evaluator = net if node_parallel else model
+            val_loss, val_rae, val_corr, _, _ = evaluate(data, data.valid[0], data.valid[1], evaluator, eval_mse_loss,
                                                          eval_l1_loss, args.batch_size)
+            if epoch % 5 == 0:
+                test_acc, test_rae, test_corr, _, _ = evaluate(data, data.test[0], data.test[1], evaluator,
+                                                               eval_mse_loss, eval_l1_loss, args.batch_size)
+            if not is_main_process():
+                continue
             print(f'| Epoch {epoch} | Time Taken for Epoch: {(time.time() - epoch_start_time)}s | Train Loss {train_loss} | '
                   f'Valid RSE {val_loss} | Valid RAE {val_rae} | Valid Correlation  {val_corr}', flush=True)
+            if model.gc.ann is not None:
+                print(f'| ANN graph recall {model.gc.ann_recall(model.idx)}', flush=True)
             # Save the model if the validation loss is the best we've seen so far.
             if val_loss < best_val:
                 with open(args.output_path+"/"+args.save, 'wb') as f:
                     torch.save(model, f)
                 best_val = val_loss
             if epoch % 5 == 0:
-                test_acc, test_rae, test_corr, _, _ = evaluate(data, data.test[0], data.test[1], model, eval_mse_loss,
-                                                               eval_l1_loss, args.batch_size)
                 print(f"Test RSE {test_acc} | TEST RAE {test_rae} | Test Correlation {test_corr}", flush=True)
     except KeyboardInterrupt:
         print('-' * 89)
         print('Exiting from training early')
+    finally:
+        if workers is not None:
+            workers.close()
+    if node_parallel:
+        # the checkpoint of rank 0 is complete
+        dist.barrier()
+    elif not is_main_process():
+        return None
 
     # Load the best saved model.
     with open(args.output_path+"/"+args.save, 'rb') as f:
-        model = torch.load(f)
+        model = torch.load(f, weights_only=False)
+    evaluator = MTGNN_NodeParallel(model, args.check_batches) if node_parallel else model
 
-    vtest_acc, vtest_rae, vtest_corr, _, _ = evaluate(data, data.valid[0], data.valid[1], model, eval_mse_loss,
+    vtest_acc, vtest_rae, vtest_corr, _, _ = evaluate(data, data.valid[0], data.valid[1], evaluator, eval_mse_loss,
                                                       eval_l1_loss, args.batch_size)
-    test_acc, test_rae, test_corr, predicted_output, actual_output = evaluate(data, data.test[0], data.test[1], model,
-                                                                              eval_mse_loss, eval_l1_loss,
+    test_acc, test_rae, test_corr, predicted_output, actual_output = evaluate(data, data.test[0], data.test[1],
+                                                                              evaluator, eval_mse_loss, eval_l1_loss,
                                                                               args.batch_size)
+    if not is_main_process():
+        return None
     print(f"Final Test RSE {test_acc} | Test RAE {test_rae} | Test Correlation {test_corr}")
 
     ## Save all the results:
-    adjacency_matrix = model.gc(torch.arange(args.num_nodes).to(device))
-    adjacency_matrix = adjacency_matrix.data.cpu().numpy()
-    result_dict = {"training_loss": all_batches_loss}
-    np.save(f"{args.output_path}/adjacency_matrix", adjacency_matrix)
-    np.save(f"{args.output_path}/predicted_output", predicted_output)
-    np.save(f"{args.output_path}/actual_output", actual_output)
-    with open(F"{args.output_path}/result.json", "w") as outfile:
-        json.dump(result_dict, outfile)
-    plt.plot(range(len(all_batches_loss)), all_batches_loss)
-    plt.savefig(f'{args.output_path}/train_loss.png')
+    save_results(model, predicted_output, actual_output, all_batches_loss)
 
     return vtest_acc, vtest_rae, vtest_corr, test_acc, test_rae, test_corr
 
 
-if __name__ == "__main__":
+def main_ensemble():
+    """
+    The no_of_runs runs of main() as one MTGNN_Ensemble: one data pipeline, one vectorized forward and backward per
+    batch, the best validation checkpoint kept per member. Returns the results of every member.
+    """
+    Path(args.output_path).mkdir(exist_ok=True)
+    data = DataLoader(args.data, 0.6, 0.2, device, args.horizon, args.seq_in_len, args.sample_data, args.normalize,
+                      streaming=args.streaming, chunk_rows=args.chunk_rows)
+    ensemble = MTGNN_Ensemble([build_model() for _ in range(args.no_of_runs)])
+    print('The receptive field size is', ensemble.template.receptive_field)
+    print(f'Number of model parameters is {sum(p[0].nelement() for p in ensemble.parameters())} per member, '
+          f'{len(ensemble)} members', flush=True)
+    train_loss_func, eval_mse_loss, eval_l1_loss = loss_functions()
+    root, ext = os.path.splitext(args.output_path + "/" + args.save)
+    paths = [f"{root}_{i}{ext}" for i in range(len(ensemble))]
+
+    best_val = [10000000] * len(ensemble)
+    optimizer = Optim(ensemble.parameters(), args.optim, args.lr, args.clip, lr_decay=args.weight_decay)
+    all_batches_loss = []
+    try:
+        print('Training started')
+        for epoch in range(1, args.epochs + 1):
+            epoch_start_time = time.time()
+            train_loss, batches_loss = train(data, data.train[0], data.train[1], ensemble, train_loss_func, optimizer,
+                                             args.batch_size)
+            all_batches_loss += batches_loss
+            results = evaluate(data, data.valid[0], data.valid[1], ensemble, eval_mse_loss, eval_l1_loss,
+                               args.batch_size)
+            val_loss, val_rae, val_corr = np.mean([result[:3] for result in results], axis=0)
+            print(f'| Epoch {epoch} | Time Taken for Epoch: {(time.time() - epoch_start_time)}s | Train Loss {train_loss} | '
+                  f'Valid RSE {val_loss} | Valid RAE {val_rae} | Valid Correlation  {val_corr} (member means)',
+                  flush=True)
+            for i, result in enumerate(results):
+                # Save every member whose validation loss is the best it has seen so far.
+                if result[0] < best_val[i]:
+                    with open(paths[i], 'wb') as f:
+                        torch.save(ensemble.member(i), f)
+                    best_val[i] = result[0]
+    except KeyboardInterrupt:
+        print('-' * 89)
+        print('Exiting from training early')
+
+    # Load the best saved members, evaluated together again.
+    models = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            models.append(torch.load(f, weights_only=False))
+    best = MTGNN_Ensemble(models)
+    valid_results = evaluate(data, data.valid[0], data.valid[1], best, eval_mse_loss, eval_l1_loss, args.batch_size)
+    test_results = evaluate(data, data.test[0], data.test[1], best, eval_mse_loss, eval_l1_loss, args.batch_size)
+    for i, (test_acc, test_rae, test_corr, _, _) in enumerate(test_results):
+        print(f"Final Test RSE {test_acc} | Test RAE {test_rae} | Test Correlation {test_corr} | member {i}")
+
+    # as after sequential runs, the saved outputs are those of the last one
+    save_results(models[-1], test_results[-1][3], test_results[-1][4], all_batches_loss)
+
+    return [valid[:3] + test[:3] for valid, test in zip(valid_results, test_results)]
+
+
+def run(rank=0, world_size=1):
+    if world_size > 1:
+        dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{args.master_port}', rank=rank,
+                                world_size=world_size)
+        if args.parallel == 'node':
+            # every rank draws the same batches and node permutations
+            seed = torch.randint(2 ** 31, (1,))
+            dist.broadcast(seed, 0)
+            torch.manual_seed(seed.item())
+            np.random.seed(seed.item())
     valid_accuracy, valid_rae, valid_correlation = [], [], []
     test_accuracy, test_RAE, test_correlation = [], [], []
     no_of_runs = args.no_of_runs
-    for i in range(no_of_runs):
-        val_acc, val_rae, val_corr, test_acc, test_rae, test_corr = main()
+    runs = main_ensemble() if args.ensemble else (main() for _ in range(no_of_runs))
+    for results in runs:
+        if results is None:
+            continue
+        val_acc, val_rae, val_corr, test_acc, test_rae, test_corr = results
         valid_accuracy.append(val_acc)
         valid_rae.append(val_rae)
         valid_correlation.append(val_corr)
         test_accuracy.append(test_acc)
         test_RAE.append(test_rae)
         test_correlation.append(test_corr)
+    if world_size > 1:
+        dist.destroy_process_group()
+    if not valid_accuracy:
+        # ranks other than 0 do not evaluate
+        return
     print(f'Average of {no_of_runs} runs')
     print(
         f"Valid RSE Mean: {np.mean(valid_accuracy)}, Valid RAE Mean: {np.mean(valid_rae)}, Valid Correlation Mean: {np.mean(valid_correlation)}")
@@ -247,3 +513,11 @@ if __name__ == "__main__":
         f"Test RSE Mean: {np.mean(test_accuracy)}, Test RAE Mean: {np.mean(test_RAE)}, Test Correlation Mean: {np.mean(test_correlation)}")
     print(f"Test RSE Standard Deviation: {np.std(test_accuracy)}, Test RAE Standard Deviation: {np.std(test_RAE)}, "
           f"Test Correlation Standard Deviation: {np.std(test_correlation)}")
+
+
+if __name__ == "__main__":
+    if args.world_size > 1:
+        # one process per rank on this host, every process re-parses the same command line
+        mp.spawn(run, args=(args.world_size,), nprocs=args.world_size)
+    else:
+        run()
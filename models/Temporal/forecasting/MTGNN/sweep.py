@@ -0,0 +1,218 @@
+import argparse
+import csv
+import itertools
+import math
+import os
+import queue
+import random
+import time
+from pathlib import Path
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+from model import MTGNN_Model
+from trainer import Optim
+from util import DataLoader, StreamingMetrics
+
+# knobs of the sweep, each given as comma separated values, and their types
+SPACE = {'subgraph_size': int, 'node_dim': int, 'conv_channels': int, 'layers': int, 'gcn_depth': int, 'lr': float}
+
+# the dataset of the sweep, loaded once by the parent and inherited by the forked workers
+data = None
+
+
+def init_worker():
+    # CUDA is only initialized after the fork, in the workers
+    torch.set_num_threads(args.threads or max(1, os.cpu_count() // args.workers))
+    data.device = torch.device(args.device)
+    data.scale = data.scale.to(data.device)
+
+
+def build_model(config):
+    channels = config['conv_channels']
+    model = MTGNN_Model(True, True, config['gcn_depth'], data.m, data.device, dropout=args.dropout,
+                        subgraph_size=config['subgraph_size'], node_dim=config['node_dim'],
+                        dilation_exponential=args.dilation_exponential, conv_channels=channels,
+                        residual_channels=channels, skip_channels=2 * channels, end_channels=4 * channels,
+                        seq_length=args.seq_in_len, in_dim=1, out_dim=1, layers=config['layers'],
+                        layer_norm_affline=False)
+    return model.to(data.device)
+
+
+def train_epoch(model, optimizer, loss_function):
+    model.train()
+    for X, Y in data.get_batches(data.train[0], data.train[1], args.batch_size, True):
+        model.zero_grad()
+        output = model(X.unsqueeze(1).transpose(2, 3))[:, 0, :, 0]
+        scale = data.scale.expand(Y.size(0), data.m)
+        loss = loss_function(output * scale, Y * scale)
+        loss.backward()
+        optimizer.step()
+
+
+def validate(model):
+    model.eval()
+    metrics = StreamingMetrics(len(data.valid[0]), data.m, data.device)
+    with torch.no_grad():
+        for X, Y in data.get_batches(data.valid[0], data.valid[1], args.batch_size, False):
+            output = model(X.unsqueeze(1).transpose(2, 3))[:, 0, :, 0]
+            error = (output - Y) * data.scale.expand(Y.size(0), data.m)
+            metrics.update(output, Y, (error ** 2).sum(), error.abs().sum())
+    return metrics.result(data.rse, data.rae)[:3]
+
+
+def run_trial(trial):
+    """
+    Trains trial `id` with `config` up to `epochs` epochs, resuming from the checkpoint of its previous rung, and
+    returns its validation RSE, RAE and correlation and the seconds it took.
+    """
+    start_time = time.perf_counter()
+    path = os.path.join(args.output_path, f"trial_{trial['id']}.pt")
+    state = torch.load(path, weights_only=False) if os.path.exists(path) else None
+    done = state['epochs'] if state else 0
+    torch.manual_seed(args.seed + 1000 * trial['id'] + done)
+    model = state['model'] if state else build_model(trial['config'])
+    optimizer = Optim(model.parameters(), args.optim, trial['config']['lr'], args.clip, lr_decay=args.weight_decay)
+    if state:
+        optimizer.optimizer.load_state_dict(state['optimizer'])
+    loss_function = nn.L1Loss(reduction='sum')
+    for _ in range(done, trial['epochs']):
+        train_epoch(model, optimizer, loss_function)
+    rse, rae, correlation = validate(model)
+    torch.save({'model': model, 'optimizer': optimizer.optimizer.state_dict(), 'epochs': trial['epochs']}, path)
+    return trial['id'], trial['epochs'], float(rse), float(rae), correlation, time.perf_counter() - start_time
+
+
+def sample_configs():
+    # the full grid of the comma separated values, or `trials` configurations drawn from it
+    values = {name: [kind(v) for v in str(getattr(args, name)).split(',')] for name, kind in SPACE.items()}
+    grid = [dict(zip(values, combination)) for combination in itertools.product(*values.values())]
+    if args.trials and args.trials < len(grid):
+        grid = random.Random(args.seed).sample(grid, args.trials)
+    return grid
+
+
+def rse_key(rse):
+    # diverged trials rank last
+    return math.inf if math.isnan(rse) else rse
+
+
+def asha(configs, pool):
+    """
+    Asynchronous successive halving (ASHA) on the validation RSE. Rung k trains for min_epochs * eta^k epochs, up to
+    max_epochs. Whenever a worker is free it gets the next trial in the top 1 / eta of a rung that has not been
+    promoted yet, from the highest rung down, or else a new trial for rung 0, so workers never wait for a rung to
+    fill up. Returns the last result of every trial.
+    """
+    rungs = [args.min_epochs]
+    while rungs[-1] * args.eta <= args.max_epochs:
+        rungs.append(rungs[-1] * args.eta)
+    rung_rse = [{} for _ in rungs]
+    promoted = [set() for _ in rungs]
+    waiting = list(range(len(configs)))
+    results = {}
+    finished = queue.Queue()
+
+    def next_trial():
+        for k in reversed(range(len(rungs) - 1)):
+            top = sorted(rung_rse[k], key=lambda trial: rse_key(rung_rse[k][trial]))[:len(rung_rse[k]) // args.eta]
+            for trial in top:
+                if trial not in promoted[k]:
+                    promoted[k].add(trial)
+                    return trial, rungs[k + 1]
+        if waiting:
+            return waiting.pop(0), rungs[0]
+        return None
+
+    running = 0
+    while True:
+        while running < args.workers:
+            job = next_trial()
+            if job is None:
+                break
+            trial = {'id': job[0], 'config': configs[job[0]], 'epochs': job[1]}
+            pool.apply_async(run_trial, (trial,), callback=finished.put, error_callback=finished.put)
+            running += 1
+        if not running:
+            return results
+        result = finished.get()
+        running -= 1
+        if isinstance(result, BaseException):
+            raise result
+        trial, epochs, rse, rae, correlation, seconds = result
+        seconds += results.get(trial, {}).get('seconds', 0.)
+        results[trial] = {'epochs': epochs, 'rse': rse, 'rae': rae, 'correlation': correlation, 'seconds': seconds}
+        rung_rse[rungs.index(epochs)][trial] = rse
+        print(f"Trial {trial} | {configs[trial]} | {epochs} epochs | Valid RSE {rse} | Valid RAE {rae} | "
+              f"Valid Correlation {correlation}", flush=True)
+
+
+def write_results(configs, results):
+    # ranked by the rung a trial reached, then by its validation RSE there
+    ranking = sorted(results, key=lambda trial: (-results[trial]['epochs'], rse_key(results[trial]['rse'])))
+    columns = ['rank', 'trial'] + list(SPACE) + ['epochs', 'valid_rse', 'valid_rae', 'valid_correlation', 'seconds']
+    rows = []
+    for rank, trial in enumerate(ranking, 1):
+        result = results[trial]
+        rows.append([rank, trial] + [configs[trial][name] for name in SPACE] +
+                    [result['epochs'], result['rse'], result['rae'], result['correlation'], round(result['seconds'], 1)])
+    with open(os.path.join(args.output_path, 'sweep_results.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    widths = [max(len(str(v)) for v in column) for column in zip(columns, *rows)]
+    for row in [columns] + rows:
+        print(' | '.join(str(v).ljust(width) for v, width in zip(row, widths)))
+
+
+parser = argparse.ArgumentParser(description='MTGNN hyperparameter sweep with ASHA')
+parser.add_argument('--data', type=str, default='./data/solar.txt', help='location of the data file')
+parser.add_argument('--output_path', type=str, default='results/sweep',
+                    help='path for the trial checkpoints and sweep_results.csv')
+parser.add_argument('--device', type=str, default='cpu', help='')
+parser.add_argument('--workers', type=int, default=2, help='trials trained at the same time')
+parser.add_argument('--threads', type=int, default=0,
+                    help='torch threads per worker, 0 splits the cores evenly over the workers')
+parser.add_argument('--trials', type=int, default=0, help='configurations drawn from the grid, 0 for all of them')
+parser.add_argument('--min_epochs', type=int, default=1, help='epochs of the first rung')
+parser.add_argument('--max_epochs', type=int, default=9, help='epochs of the last rung at most')
+parser.add_argument('--eta', type=int, default=3, help='1 / eta of every rung is promoted to the next one')
+parser.add_argument('--seed', type=int, default=0, help='seed of the trial sampling and the model initialization')
+parser.add_argument('--subgraph_size', type=str, default='20', help='k values')
+parser.add_argument('--node_dim', type=str, default='40', help='node embedding dims')
+parser.add_argument('--conv_channels', type=str, default='16',
+                    help='convolution channels, residual/skip/end channels are 1/2/4 times as many')
+parser.add_argument('--layers', type=str, default='5', help='numbers of layers')
+parser.add_argument('--gcn_depth', type=str, default='2', help='graph convolution depths')
+parser.add_argument('--lr', type=str, default='0.0001', help='learning rates')
+parser.add_argument('--optim', type=str, default='adam')
+parser.add_argument('--clip', type=int, default=5, help='clip')
+parser.add_argument('--weight_decay', type=float, default=0.00001, help='weight decay rate')
+parser.add_argument('--dropout', type=float, default=0.3, help='dropout rate')
+parser.add_argument('--dilation_exponential', type=int, default=2, help='dilation exponential')
+parser.add_argument('--normalize', type=int, default=2)
+parser.add_argument('--streaming', action='store_true',
+                    help='fit the scalers chunk by chunk and normalize into a memory-mapped store, as without it')
+parser.add_argument('--chunk_rows', type=int, default=100000, help='rows per chunk in streaming mode')
+parser.add_argument('--seq_in_len', type=int, default=24 * 7, help='input sequence length')
+parser.add_argument('--horizon', type=int, default=3)
+parser.add_argument('--batch_size', type=int, default=32, help='batch size')
+parser.add_argument('--sample_data', type=int, default=0, help='Sample no of records to run for benchmark')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    Path(args.output_path).mkdir(parents=True, exist_ok=True)
+    # trials resume from these checkpoints between rungs, so those of an earlier sweep must not be picked up
+    for checkpoint in Path(args.output_path).glob('trial_*.pt'):
+        checkpoint.unlink()
+    # loaded as mtgnn.py loads it, so that trials are ranked on the same splits and scaling as the final training;
+    # the forked workers share the pages of the series copy-on-write (of the memmap with --streaming)
+    data = DataLoader(args.data, 0.6, 0.2, torch.device('cpu'), args.horizon, args.seq_in_len, args.sample_data,
+                      args.normalize, streaming=args.streaming, chunk_rows=args.chunk_rows)
+    configs = sample_configs()
+    print(f'{len(configs)} trials, {args.workers} workers', flush=True)
+    with mp.get_context('fork').Pool(args.workers, initializer=init_worker) as pool:
+        results = asha(configs, pool)
+    write_results(configs, results)
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+import torch
+
+from util import DataLoader
+
+
+@pytest.fixture
+def series(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.gamma(2., 3., size=(400, 6)) * rng.uniform(0.5, 4., size=6)
+    # the largest values sit in the test rows, which a train-only fit would miss
+    data[-10:] *= 2
+    path = tmp_path / 'series.txt'
+    np.savetxt(path, data, delimiter=',')
+    return str(path)
+
+
+@pytest.mark.parametrize('normalize', [0, 1, 2, 3])
+@pytest.mark.parametrize('sample_data', [0, 300])
+def test_streaming_matches_in_memory(series, normalize, sample_data):
+    loaders = [DataLoader(series, 0.6, 0.2, torch.device('cpu'), 3, 24, sample_data, normalize, streaming=streaming,
+                          chunk_rows=64) for streaming in [False, True]]
+    in_memory, streaming = loaders
+    assert torch.allclose(in_memory.scale, streaming.scale)
+    for split in ['train', 'valid', 'test']:
+        for a, b in zip(getattr(in_memory, split), getattr(streaming, split)):
+            assert torch.allclose(a, b, rtol=1e-6, atol=1e-6)
+    assert torch.allclose(in_memory.rse, streaming.rse) and torch.allclose(in_memory.rae, streaming.rae)
@@ -0,0 +1,25 @@
+import torch
+
+from util import BatchPrefetcher
+
+
+def test_early_break_joins_the_producer():
+    inputs = torch.randn(100, 8, 5)
+    targets = torch.randn(100, 5)
+    prefetcher = BatchPrefetcher(inputs, targets, torch.arange(100), 4, 'cpu', depth=2)
+    batches = iter(prefetcher)
+    X, Y = next(batches)
+    assert torch.equal(X, inputs[:4]) and torch.equal(Y, targets[:4])
+    # the producer is blocked on the full queue by now
+    batches.close()
+    assert not prefetcher.thread.is_alive()
+
+
+def test_full_pass_matches_the_index():
+    inputs = torch.randn(10, 3, 2)
+    targets = torch.randn(10, 2)
+    index = torch.randperm(10)
+    prefetcher = BatchPrefetcher(inputs, targets, index, 4, 'cpu')
+    X = torch.cat([X for X, _ in prefetcher])
+    assert torch.equal(X, inputs[index])
+    assert not prefetcher.thread.is_alive()
@@ -0,0 +1,37 @@
+import pytest
+import torch
+
+from model import MTGNN_Frozen, MTGNN_Model
+
+
+def small_model():
+    torch.manual_seed(0)
+    return MTGNN_Model(True, True, 2, 30, torch.device('cpu'), subgraph_size=5, node_dim=8, dilation_exponential=2,
+                       conv_channels=8, residual_channels=8, skip_channels=16, end_channels=32, seq_length=32,
+                       in_dim=1, out_dim=1, layers=3)
+
+
+@pytest.mark.parametrize('mode', ['dynamic', 'static'])
+def test_fp32_and_int8_runs_share_the_graph(mode):
+    # load_model.py --quantize compares both runs on one MTGNN_Frozen graph
+    model = small_model()
+    x = torch.randn(8, 1, 30, 32)
+    graphs = []
+    forward = model._forward
+
+    def recording(input, plan, idx=None):
+        graphs.append(plan.adj.clone())
+        return forward(input, plan, idx)
+
+    model._forward = recording
+    torch.manual_seed(0)
+    pinned = MTGNN_Frozen(model)
+    with torch.no_grad():
+        fp32 = pinned(x)
+        model.quantize(mode, [torch.randn(8, 1, 30, 32) for _ in range(4)])
+        # a different RNG state and a fresh eval() must not draw another graph
+        torch.manual_seed(1)
+        pinned.eval()
+        int8 = pinned(x)
+    assert torch.equal(graphs[0], graphs[-1])
+    assert ((int8 - fp32).norm() / fp32.norm()).item() < 0.2
@@ -3,8 +3,12 @@ import math
 from model import *
 import util
 class Trainer():
-    def __init__(self, model, lrate, wdecay, clip, step_size, seq_out_len, scaler, device, cl=True):
+    def __init__(self, model, lrate, wdecay, clip, step_size, seq_out_len, scaler, device, cl=True, bf16=False,
+                 flush_interval=1):
         self.scaler = scaler
+        self.device = torch.device(device)
+        # bfloat16 autocast for the forward, the parameters, optimizer state and loss stay in fp32
+        self.bf16 = bf16
         self.model = model
         self.model.to(device)
         self.optimizer = optim.Adam(self.model.parameters(), lr=lrate, weight_decay=wdecay)
@@ -15,12 +19,22 @@ class Trainer():
         self.task_level = 1
         self.seq_out_len = seq_out_len
         self.cl = cl
+        # the training metrics stay on the device for flush_interval steps between host syncs
+        self.flush_interval = flush_interval
+        self.metrics = util.MetricAccumulator()
+        self.last_metrics = None
 
     def train(self, input, real_val, idx=None):
+        """
+        One training step. Returns a (loss, mape, rmse) tuple of floats on every step: the means over the last
+        flush_interval steps, refreshed (with one host sync) on the first step and every flush_interval steps after,
+        and repeated unchanged on the steps in between. With flush_interval=1 they are the metrics of this step.
+        """
         self.model.train()
         self.optimizer.zero_grad()
-        output = self.model(input, idx=idx)
-        output = output.transpose(1,3)
+        with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            output = self.model(input, idx=idx)
+        output = output.float().transpose(1,3)
         real = torch.unsqueeze(real_val,dim=1)
         predict = self.scaler.inverse_transform(output)
         if self.iter%self.step==0 and self.task_level<=self.seq_out_len:
@@ -36,22 +50,31 @@ class Trainer():
             torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
 
         self.optimizer.step()
-        # mae = util.masked_mae(predict,real,0.0).item()
-        mape = util.masked_mape(predict,real,0.0).item()
-        rmse = util.masked_rmse(predict,real,0.0).item()
+        with torch.no_grad():
+            _, mape, rmse, _ = util.masked_metrics(predict, real, 0.0)
+        self.metrics.add(torch.stack([loss.detach(), mape, rmse]))
         self.iter += 1
-        return loss.item(),mape,rmse
+        if self.last_metrics is None or self.metrics.steps >= self.flush_interval:
+            self.last_metrics = tuple(self.metrics.flush())
+        return self.last_metrics
+
+    def flush_metrics(self):
+        # (loss, mape, rmse) means over the steps not flushed yet, e.g. at the end of an epoch, None if there are none
+        metrics = self.metrics.flush()
+        if metrics is None:
+            return None
+        self.last_metrics = tuple(metrics)
+        return self.last_metrics
 
     def eval(self, input, real_val):
         self.model.eval()
-        output = self.model(input)
-        output = output.transpose(1,3)
+        with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            output = self.model(input)
+        output = output.float().transpose(1,3)
         real = torch.unsqueeze(real_val,dim=1)
         predict = self.scaler.inverse_transform(output)
-        loss = self.loss(predict, real, 0.0)
-        mape = util.masked_mape(predict,real,0.0).item()
-        rmse = util.masked_rmse(predict,real,0.0).item()
-        return loss.item(),mape,rmse
+        loss, mape, rmse, _ = util.masked_metrics(predict, real, 0.0).tolist()
+        return loss,mape,rmse
 
 
 
@@ -1,3 +1,12 @@
+import hashlib
+import itertools
+import json
+import math
+import os
+import queue
+import threading
+import time
+
 import numpy as np
 import scipy.sparse as sp
 import torch
@@ -6,15 +15,21 @@ from torch.autograd import Variable
 
 class DataLoader(object):
     # train and valid is the ratio of training set and validation set. test = 1 - train - valid
-    def __init__(self, file_name, train, valid, device, horizon, window, sample_data=None, normalize=2, ):
+    def __init__(self, file_name, train, valid, device, horizon, window, sample_data=None, normalize=2, streaming=False,
+                 chunk_rows=100000):
         self.P = window
         self.h = horizon
-        self.rawdat = np.loadtxt(open(file_name), delimiter=',')
-        self.dat = np.zeros(self.rawdat.shape)
-        self.n, self.m = self.dat.shape
+        self.shuffles = 0
+        self.rawdat = load_series(file_name)
+        self.n, self.m = self.rawdat.shape
         self.normalize = 2
         self.scale = np.ones(self.m)
-        self._normalized(normalize)
+        self.shift = np.zeros(self.m)
+        if streaming:
+            self._streaming_normalized(file_name, normalize, sample_data, chunk_rows)
+        else:
+            self.dat = np.zeros(self.rawdat.shape)
+            self._normalized(normalize)
 
         # Run on sample data
         if sample_data:
@@ -46,48 +61,379 @@ class DataLoader(object):
 
         # normlized by the maximum value of each row(sensor).
         if (normalize == 2):
-            for i in range(self.m):
-                self.scale[i] = np.max(np.abs(self.rawdat[:, i]))
-                self.dat[:, i] = self.rawdat[:, i] / np.max(np.abs(self.rawdat[:, i]))
+            self.scale = np.max(np.abs(self.rawdat), axis=0)
+            self.dat = self.rawdat / self.scale
+
+        # standardized by the mean and std of each sensor.
+        if (normalize == 3):
+            self.shift = np.mean(self.rawdat, axis=0)
+            self.scale = np.std(self.rawdat, axis=0)
+            self.dat = (self.rawdat - self.shift) / self.scale
+
+    def _streaming_normalized(self, file_name, normalize, sample_data, chunk_rows):
+        # The same scalers as _normalized, fitted on every row of the series one chunk at a time, and the normalized
+        # (sampled) rows are then written chunk by chunk into a float32 memmap, so peak memory is bounded by chunk_rows
+        # instead of the series.
+        chunks = [self.rawdat[i:i + chunk_rows] for i in range(0, self.n, chunk_rows)]
+
+        if (normalize == 1):
+            # the rows are divided by the maximum of the matrix, but as in _normalized the scale of the metrics stays 1
+            divisor = np.full(self.m, max(np.max(chunk) for chunk in chunks))
+
+        if (normalize == 2):
+            self.scale = np.zeros(self.m)
+            for chunk in chunks:
+                self.scale = np.maximum(self.scale, np.max(np.abs(chunk), axis=0))
+
+        if (normalize == 3):
+            # chunk-wise mean/variance merged with Chan et al.'s parallel update
+            count, mean, m2 = 0, np.zeros(self.m), np.zeros(self.m)
+            for chunk in chunks:
+                chunk = np.asarray(chunk, dtype=np.float64)
+                k = len(chunk)
+                chunk_mean = chunk.mean(axis=0)
+                delta = chunk_mean - mean
+                mean += delta * k / (count + k)
+                m2 += ((chunk - chunk_mean) ** 2).sum(axis=0) + delta ** 2 * count * k / (count + k)
+                count += k
+            self.shift = mean
+            self.scale = np.sqrt(m2 / count)
+
+        if (normalize != 1):
+            divisor = self.scale
+        divisor[divisor == 0] = 1
+        if sample_data:
+            self.n = min(self.n, sample_data)
+        try:
+            # per process, ranks of a distributed run would otherwise truncate the store under each other
+            norm_path = '%s.norm.%d.npy' % (file_name, os.getpid())
+            self.dat = np.lib.format.open_memmap(norm_path, mode='w+', dtype=np.float32, shape=(self.n, self.m))
+            try:
+                # the mapping outlives the name where the platform allows it
+                os.remove(norm_path)
+            except OSError:
+                pass
+        except OSError:
+            self.dat = np.empty((self.n, self.m), dtype=np.float32)
+        for i in range(0, self.n, chunk_rows):
+            self.dat[i:i + chunk_rows] = (self.rawdat[i:min(i + chunk_rows, self.n)] - self.shift) / divisor
 
     def _split(self, train, valid, test):
 
         train_set = range(self.P + self.h - 1, train)
         valid_set = range(train, valid)
         test_set = range(valid, self.n)
+        self.series = torch.from_numpy(np.ascontiguousarray(self.dat, dtype=np.float32))
         self.train = self._batchify(train_set, self.h)
         self.valid = self._batchify(valid_set, self.h)
         self.test = self._batchify(test_set, self.h)
 
     def _batchify(self, idx_set, horizon):
+        # X and Y are strided views over self.series, windows are only copied when get_batches gathers a batch
         n = len(idx_set)
-        X = torch.zeros((n, self.P, self.m))
-        Y = torch.zeros((n, self.m))
-        for i in range(n):
-            end = idx_set[i] - self.h + 1
-            start = end - self.P
-            X[i, :, :] = torch.from_numpy(self.dat[start:end, :])
-            Y[i, :] = torch.from_numpy(self.dat[idx_set[i], :])
+        start = idx_set.start - horizon + 1 - self.P
+        X = self.series.unfold(0, self.P, 1)[start:start + n].transpose(1, 2)
+        Y = self.series[idx_set.start:idx_set.start + n]
         return [X, Y]
 
-    def get_batches(self, inputs, targets, batch_size, shuffle=True):
+    def get_batches(self, inputs, targets, batch_size, shuffle=True, prefetch=0, rank=0, world_size=1,
+                    seeded=False):
+        # self.stall_time is reset on every call and holds the seconds the caller spent waiting on batches
         length = len(inputs)
-        if shuffle:
+        if shuffle and (world_size > 1 or seeded):
+            # every rank has to draw the same permutation, so it is seeded with the number of shuffled passes so far
+            # (seeded: for ranks that all run every batch, whose global RNG streams drift apart)
+            index = torch.randperm(length, generator=torch.Generator().manual_seed(self.shuffles))
+        elif shuffle:
             index = torch.randperm(length)
         else:
             index = torch.LongTensor(range(length))
+        if shuffle:
+            self.shuffles += 1
+        if world_size > 1:
+            # strided shard of the permutation per rank, wrapped around so that every rank runs as many batches
+            index = torch.cat([index, index[:-length % world_size]])[rank::world_size]
+            length = len(index)
+        self.stall_time = 0.
+        if prefetch > 0:
+            prefetcher = BatchPrefetcher(inputs, targets, index, batch_size, self.device, prefetch)
+            for X, Y in prefetcher:
+                self.stall_time = prefetcher.stall_time
+                yield Variable(X), Variable(Y)
+            return
         start_idx = 0
         while (start_idx < length):
+            start_time = time.perf_counter()
             end_idx = min(length, start_idx + batch_size)
             excerpt = index[start_idx:end_idx]
             X = inputs[excerpt]
             Y = targets[excerpt]
             X = X.to(self.device)
             Y = Y.to(self.device)
+            self.stall_time += time.perf_counter() - start_time
             yield Variable(X), Variable(Y)
             start_idx += batch_size
 
 
+class BatchPrefetcher(object):
+    """
+    Gathers the batches of DataLoader.get_batches on a background thread while the current step runs, at most
+    `depth` batches ahead through a bounded queue. On CUDA the windows are gathered into a ring of depth + 2 pinned
+    host buffers and copied with non_blocking=True; a buffer is refilled only once the copy out of it has finished.
+    On CPU every batch gets fresh tensors, since the yielded batch would otherwise alias a buffer being refilled.
+    stall_time accumulates the seconds the consumer waited on the queue. The background thread is joined whenever
+    the iteration ends, also when the consumer stops early, so it is never left running inside torch at exit.
+    """
+
+    def __init__(self, inputs, targets, index, batch_size, device, depth=2):
+        self.inputs = inputs
+        self.targets = targets
+        self.index = index
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.depth = depth
+        self.stall_time = 0.
+        self.thread = None
+        self.pinned = self.device.type == 'cuda'
+        self.slots = []
+        if self.pinned:
+            for _ in range(depth + 2):
+                X = torch.empty((batch_size,) + tuple(inputs.shape[1:]), dtype=inputs.dtype, pin_memory=True)
+                Y = torch.empty((batch_size,) + tuple(targets.shape[1:]), dtype=targets.dtype, pin_memory=True)
+                self.slots.append([X, Y, None])
+
+    @staticmethod
+    def _put(batches, item, stop):
+        # gives up once the consumer has stopped, so that the producer never blocks on a full queue
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, batches, stop):
+        try:
+            for i, start_idx in enumerate(range(0, len(self.index), self.batch_size)):
+                excerpt = self.index[start_idx:start_idx + self.batch_size]
+                if self.pinned:
+                    slot = self.slots[i % len(self.slots)]
+                    if slot[2] is not None:
+                        slot[2].synchronize()
+                    X = torch.index_select(self.inputs, 0, excerpt, out=slot[0][:len(excerpt)])
+                    Y = torch.index_select(self.targets, 0, excerpt, out=slot[1][:len(excerpt)])
+                    item = (X, Y, slot)
+                else:
+                    item = (self.inputs[excerpt], self.targets[excerpt], None)
+                if not self._put(batches, item, stop):
+                    return
+            self._put(batches, None, stop)
+        except Exception as e:
+            self._put(batches, e, stop)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        self.thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        self.thread.start()
+        try:
+            while True:
+                start_time = time.perf_counter()
+                item = batches.get()
+                if isinstance(item, Exception):
+                    raise item
+                if item is None:
+                    return
+                X, Y, slot = item
+                X = X.to(self.device, non_blocking=self.pinned)
+                Y = Y.to(self.device, non_blocking=self.pinned)
+                if slot is not None:
+                    slot[2] = torch.cuda.Event()
+                    slot[2].record()
+                self.stall_time += time.perf_counter() - start_time
+                yield X, Y
+        finally:
+            stop.set()
+            # drained so that a put in flight returns, then joined
+            while True:
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    break
+            self.thread.join()
+
+
+def _file_sha1(file_name, block_size=1 << 24):
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _data_lines(f):
+    # the lines np.loadtxt parses rows from: it skips empty lines and lines holding only a '#' comment
+    return (line for line in f if line.split('#', 1)[0].rstrip('\r\n'))
+
+
+def _convert_csv(file_name, npy_path, chunk_rows=100000):
+    # Two passes over the text file so that the whole matrix never has to be held in memory as python floats
+    with open(file_name) as f:
+        lines = _data_lines(f)
+        first = next(lines, '')
+        n = (1 if first else 0) + sum(1 for _ in lines)
+    m = len(first.split('#', 1)[0].split(','))
+    # per process, so that ranks of a distributed run converting the same file do not write into each other
+    tmp_path = npy_path + '.%d.tmp' % os.getpid()
+    try:
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64, shape=(n, m))
+        row = 0
+        with open(file_name) as f:
+            lines = _data_lines(f)
+            while row < n:
+                chunk = np.loadtxt(itertools.islice(lines, chunk_rows), delimiter=',', ndmin=2)
+                if not len(chunk) or chunk.shape[1] != m:
+                    raise ValueError(f'{file_name} changed while it was converted, or its rows differ in length')
+                out[row:row + len(chunk)] = chunk
+                row += len(chunk)
+        out.flush()
+        del out
+        os.replace(tmp_path, npy_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_series(file_name, cache=True):
+    """
+    Load a comma separated (T, m) series. The first call converts the text into a raw .npy next to the source file
+    with a .json sidecar holding the sha1 of the source, later calls memory-map the .npy instead of re-parsing.
+    :param file_name: path of the csv/txt file
+    :param cache: if False, or the cache can not be written, fall back to np.loadtxt
+    :return: np.ndarray, a read-only memmap when the cache is used
+    """
+    if not cache:
+        return np.loadtxt(open(file_name), delimiter=',')
+    npy_path = file_name + '.npy'
+    meta_path = file_name + '.meta.json'
+    stat = os.stat(file_name)
+    meta = None
+    if os.path.exists(npy_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['size'] != stat.st_size or meta['mtime'] != stat.st_mtime:
+            # cheap check failed, only the content hash decides whether the cache is stale
+            sha1 = _file_sha1(file_name)
+            if meta['sha1'] != sha1:
+                meta = None
+            else:
+                meta.update(size=stat.st_size, mtime=stat.st_mtime)
+                with open(meta_path, 'w') as f:
+                    json.dump(meta, f)
+    if meta is None:
+        try:
+            _convert_csv(file_name, npy_path)
+            meta = {'sha1': _file_sha1(file_name), 'size': stat.st_size, 'mtime': stat.st_mtime}
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        except (OSError, ValueError):
+            # not writable, or not a matrix the chunked conversion can parse, np.loadtxt reports the latter itself
+            return np.loadtxt(open(file_name), delimiter=',')
+    return np.load(npy_path, mmap_mode='r')
+
+
+class CompiledModel(object):
+    """
+    Inference artifact written by MTGNN_Model.export, loaded without the model classes: a TorchScript module, a
+    torch.export program for a .pt2 file, or an ONNX graph for a .onnx file, run by onnxruntime on its CPU execution
+    provider with all graph optimizations and `threads` intra-op threads (0 leaves the choice to the runtime). It only
+    runs the (batch_size, num_nodes, seq_length) shape it was exported for, so a smaller last batch is zero padded up
+    to batch_size and the padding dropped from the output.
+    """
+
+    def __init__(self, file_name, device='cpu', threads=0):
+        self.session = None
+        if file_name.endswith('.onnx'):
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(file_name, options, providers=['CPUExecutionProvider'])
+            self.batch_size = self.session.get_inputs()[0].shape[0]
+            return
+        extra_files = {'meta.json': ''}
+        if file_name.endswith('.pt2'):
+            self.module = torch.export.load(file_name, extra_files=extra_files).module()
+        else:
+            self.module = torch.jit.load(file_name, map_location=device, _extra_files=extra_files)
+        self.batch_size = json.loads(extra_files['meta.json'])['batch_size']
+
+    def eval(self):
+        return self
+
+    def __call__(self, input):
+        n = input.size(0)
+        if n < self.batch_size:
+            input = torch.cat([input, input.new_zeros((self.batch_size - n,) + tuple(input.shape[1:]))])
+        if self.session is not None:
+            output = self.session.run(None, {'input': input.cpu().numpy()})[0]
+            return torch.from_numpy(output).to(input.device)[:n]
+        with torch.no_grad():
+            return self.module(input)[:n]
+
+
+class StreamingMetrics(object):
+    """
+    Outputs and metrics of one evaluation pass over `n` windows of `m` nodes, accumulated batch by batch on the
+    device of the batches. Predictions and targets are written into buffers preallocated for the whole pass, the
+    summed squared and absolute errors stay device tensors, and the per-node means, sums of squared deviations and
+    co-moment of the correlation are merged per batch with the parallel form of Welford's algorithm, in float64.
+    result() is the only point the host waits on the device.
+    """
+
+    def __init__(self, n, m, device):
+        self.predicted = torch.empty(n, m, device=device)
+        self.actual = torch.empty(n, m, device=device)
+        self.count = 0
+        self.errors = torch.zeros(2, dtype=torch.float64, device=device)
+        # rows: predicted, actual
+        self.mean = torch.zeros(2, m, dtype=torch.float64, device=device)
+        self.m2 = torch.zeros(2, m, dtype=torch.float64, device=device)
+        self.comoment = torch.zeros(m, dtype=torch.float64, device=device)
+
+    def update(self, output, target, squared_error, absolute_error):
+        # output, target: (batch, m), the errors are the summed (scaled) errors of the batch
+        n_a, n_b = self.count, output.size(0)
+        n = n_a + n_b
+        self.predicted[n_a:n] = output
+        self.actual[n_a:n] = target
+        self.errors += torch.stack([squared_error, absolute_error]).double()
+        batch = torch.stack([output, target]).double()
+        batch_mean = batch.mean(1)
+        centered = batch - batch_mean.unsqueeze(1)
+        delta = batch_mean - self.mean
+        self.mean += delta * (n_b / n)
+        self.m2 += (centered ** 2).sum(1) + delta ** 2 * (n_a * n_b / n)
+        self.comoment += (centered[0] * centered[1]).sum(0) + delta[0] * delta[1] * (n_a * n_b / n)
+        self.count = n
+
+    def result(self, rse, rae):
+        """
+        RSE and RAE relative to the `rse` and `rae` of the data, the mean correlation over the nodes whose target
+        varies, and the predictions and targets as numpy arrays.
+        """
+        m = self.comoment.size(0)
+        stats = torch.cat([self.errors, self.m2.flatten(), self.comoment]).cpu()
+        squared_error, absolute_error = stats[:2].tolist()
+        m2 = stats[2:2 + 2 * m].view(2, m)
+        correlation = stats[2 + 2 * m:] / (m2[0] * m2[1]).sqrt()
+        n_values = self.count * m
+        return (math.sqrt(squared_error / n_values) / rse, (absolute_error / n_values) / rae,
+                correlation[m2[1] != 0].mean().item(), self.predicted.cpu().numpy(), self.actual.cpu().numpy())
+
+
 def calculate_normalized_laplacian(adj):
     """
     # L = D^-1/2 (D-A) D^-1/2 = I - D^-1/2 A D^-1/2
@@ -150,5 +496,48 @@ def masked_mape(preds, labels, null_val=np.nan):
     return torch.mean(loss)
 
 
+def masked_metrics(preds, labels, null_val=np.nan):
+    """
+    masked_mae, masked_mape, masked_rmse and masked_mse of the same predictions in one pass with one mask, as a
+    tensor [mae, mape, rmse, mse] on the device of preds.
+    """
+    if np.isnan(null_val):
+        mask = ~torch.isnan(labels)
+    else:
+        mask = (labels != null_val)
+    mask = mask.float()
+    mask /= torch.mean((mask))
+    mask = torch.where(torch.isnan(mask), torch.zeros_like(mask), mask)
+    error = preds - labels
+    loss = torch.stack([torch.abs(error), torch.abs(error) / labels, error ** 2])
+    loss = loss * mask
+    loss = torch.where(torch.isnan(loss), torch.zeros_like(loss), loss)
+    mae, mape, mse = loss.flatten(1).mean(1)
+    return torch.stack([mae, mape, torch.sqrt(mse), mse])
+
+
+class MetricAccumulator(object):
+    """
+    Running sum of per-step metric tensors, kept on their device. flush() returns the means over the steps since
+    the last flush as floats, the only point the host waits on the device.
+    """
+
+    def __init__(self):
+        self.total = None
+        self.steps = 0
+
+    def add(self, values):
+        self.total = values if self.total is None else self.total + values
+        self.steps += 1
+
+    def flush(self):
+        if not self.steps:
+            return None
+        means = (self.total / self.steps).tolist()
+        self.total = None
+        self.steps = 0
+        return means
+
+
 def normal_std(x):
     return x.std() * np.sqrt((len(x) - 1.) / (len(x)))